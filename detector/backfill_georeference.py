@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Backfill Detection.latitude, longitude and isInsideConvexHull for existing
+detections, in chunks, from their cameras' current Location control points.
+
+    DATABASE_URL=... python backfill_georeference.py --chunk-size 1000
+
+By default only detections without a latitude are touched; --all recomputes
+every detection, for example after control points were moved.
+"""
+
+import argparse
+from collections import defaultdict
+
+from prisma import Prisma
+
+from georeference import camera_transforms, georeference
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill detection coordinates")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="recompute detections that already have coordinates",
+    )
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    db = Prisma()
+    db.connect()
+
+    last_id = None
+    scanned = updated = 0
+    while True:
+        # Keyset pagination, so rows updated along the way don't shift pages
+        where = {} if args.all else {"latitude": None}
+        if last_id is not None:
+            where["id"] = {"gt": last_id}
+        chunk = db.detection.find_many(
+            where=where,
+            take=args.chunk_size,
+            order={"id": "asc"},
+            include={"image": True},
+        )
+        if not chunk:
+            break
+        last_id = chunk[-1].id
+        scanned += len(chunk)
+
+        by_image = defaultdict(list)
+        for detection in chunk:
+            by_image[detection.imageId].append(detection)
+        transforms = camera_transforms(
+            db, {detection.image.cameraId for detection in chunk}
+        )
+
+        updates = []
+        for detections in by_image.values():
+            transform = transforms[detections[0].image.cameraId]
+            boxes = [[d.xMin, d.yMin, d.xMax, d.yMax] for d in detections]
+            for detection, fields in zip(detections, georeference(transform, boxes)):
+                if any(value is not None for value in fields.values()):
+                    updates.append((detection.id, fields))
+
+        if updates and not args.dry_run:
+            with db.batch_() as batcher:
+                for detection_id, fields in updates:
+                    batcher.detection.update(where={"id": detection_id}, data=fields)
+        updated += len(updates)
+        print(f"Scanned {scanned} detections, georeferenced {updated}.")
+
+    db.disconnect()
+    print(f"Done: georeferenced {updated} of {scanned} detections.")
+
+
+if __name__ == "__main__":
+    main()
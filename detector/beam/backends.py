@@ -0,0 +1,376 @@
+"""
+Interchangeable object detection backends.
+
+Every backend has a `detect(images)` method taking a list of PIL images and
+returning one dict per image with its `detections`, `width` and `height`, in
+the schema the detector stores.  Two backends exist:
+
+  * "detr": the HuggingFace DETR model in PyTorch, on a GPU when available.
+    This is the reference.
+  * "onnx": the same model exported with export_onnx.py, optionally
+    quantized to int8, run with ONNX Runtime on a plain CPU.  It needs only
+    numpy, Pillow and onnxruntime, so it also fits in the detector Lambda.
+
+The DETR backend can also start warm from a safetensors export of itself
+(see DetrBackend.from_warm_start), skipping the hub and random weight
+initialisation.
+
+This module imports nothing heavy at the top level; each backend imports
+what it needs when it is created.
+"""
+
+import copy
+import itertools
+import json
+import logging
+import os
+import shutil
+import time
+from PIL import Image as PILImage
+
+
+# Detections scoring at or below this are dropped by default
+DETECTION_THRESHOLD = 0.6
+
+DETR_MODEL_NAME = "facebook/detr-resnet-101"
+DETR_MODEL_REVISION = "no_timm"
+
+# File name of the weights in a warm start export
+WARM_START_WEIGHTS = "model.safetensors"
+
+# DetrImageProcessor's defaults, which the ONNX backend reproduces
+IMAGE_MEAN = (0.485, 0.456, 0.406)
+IMAGE_STD = (0.229, 0.224, 0.225)
+SHORTEST_EDGE = 800
+LONGEST_EDGE = 1333
+
+
+def format_detections(images, rows, id2label, threshold=DETECTION_THRESHOLD):
+    """
+    Turn per-query (score, label, x_min, y_min, x_max, y_max) rows, one list
+    per image, into the detection schema, dropping low-scoring queries.
+    """
+    results = []
+    for image, image_rows in zip(images, rows):
+        detections = []
+        for score, label, x_min, y_min, x_max, y_max in image_rows:
+            if score <= threshold:
+                continue
+            detections.append(
+                {
+                    "label": id2label[int(label)],
+                    "confidence": round(score, 3),
+                    "box": {
+                        "xMin": round(x_min, 2),
+                        "yMin": round(y_min, 2),
+                        "xMax": round(x_max, 2),
+                        "yMax": round(y_max, 2),
+                    },
+                }
+            )
+        results.append(
+            {"detections": detections, "width": image.width, "height": image.height}
+        )
+    return results
+
+
+class _StartupTimer:
+    """Wall time of each phase of loading a backend, logged as one line."""
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = {}
+        self._start = self._last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases[f"{phase}_ms"] = round((now - self._last) * 1000, 1)
+        self._last = now
+
+    def log(self, **extra):
+        total_ms = round((time.perf_counter() - self._start) * 1000, 1)
+        logging.info(
+            json.dumps(
+                {"startup": self.name, **self.phases, "total_ms": total_ms, **extra}
+            )
+        )
+
+
+def warm_start_dir(cache_dir):
+    """Where the warm start export of the pinned DETR model is kept."""
+    name = f"{DETR_MODEL_NAME.replace('/', '--')}-{DETR_MODEL_REVISION}"
+    return os.path.join(cache_dir, "warm-start", name)
+
+
+class DetrBackend:
+    """The reference HuggingFace DETR model in PyTorch."""
+
+    name = "detr"
+
+    def __init__(self, model, processor, device, fp16=False):
+        self.model = model
+        self.processor = processor
+        self.device = device
+        self.fp16 = fp16
+
+    @classmethod
+    def from_pretrained(cls, cache_dir=None, fp16=False):
+        timer = _StartupTimer("detr-pretrained")
+        from transformers import DetrImageProcessor, DetrForObjectDetection
+        import torch
+
+        timer.lap("import")
+
+        processor = DetrImageProcessor.from_pretrained(
+            DETR_MODEL_NAME, revision=DETR_MODEL_REVISION, cache_dir=cache_dir
+        )
+        timer.lap("processor")
+        model = DetrForObjectDetection.from_pretrained(
+            DETR_MODEL_NAME, revision=DETR_MODEL_REVISION, cache_dir=cache_dir
+        )
+        timer.lap("model")
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model.to(device)
+        model.eval()
+        timer.lap("to_device")
+        timer.log(device=device)
+        return cls(model, processor, device, fp16=fp16 and device == "cuda")
+
+    @classmethod
+    def from_export(cls, export_dir, fp16=False):
+        """
+        Load a model saved by export() without going near the hub.  The model
+        is built on the meta device, so no time goes on initialising weights
+        about to be replaced, and then takes its weights straight from the
+        memory-mapped safetensors file, one tensor at a time, on the device.
+        """
+        timer = _StartupTimer("detr-export")
+        from safetensors import safe_open
+        from transformers import DetrConfig, DetrForObjectDetection, DetrImageProcessor
+        import torch
+
+        timer.lap("import")
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        processor = DetrImageProcessor.from_pretrained(
+            export_dir, local_files_only=True
+        )
+        config = DetrConfig.from_pretrained(export_dir, local_files_only=True)
+        timer.lap("config")
+
+        with torch.device("meta"):
+            model = DetrForObjectDetection(config)
+        timer.lap("build")
+
+        weights_path = os.path.join(export_dir, WARM_START_WEIGHTS)
+        with safe_open(weights_path, framework="pt", device=device) as weights:
+            state_dict = {name: weights.get_tensor(name) for name in weights.keys()}
+        model.load_state_dict(state_dict, assign=True)
+        timer.lap("weights")
+
+        missing = [
+            name
+            for name, tensor in itertools.chain(
+                model.named_parameters(), model.named_buffers()
+            )
+            if tensor.is_meta
+        ]
+        if missing:
+            raise RuntimeError(f"Export has no values for {', '.join(missing)}")
+        model.eval()
+        timer.log(device=device)
+        return cls(model, processor, device, fp16=fp16 and device == "cuda")
+
+    @classmethod
+    def from_warm_start(cls, export_dir, cache_dir=None, fp16=False):
+        """
+        Load from the export in `export_dir`, or on the first start, when
+        there is none yet, load the pretrained model and export it there.
+        """
+        if os.path.exists(os.path.join(export_dir, WARM_START_WEIGHTS)):
+            try:
+                return cls.from_export(export_dir, fp16=fp16)
+            except Exception as e:
+                logging.warning(f"Warm start from {export_dir} failed: {e}")
+
+        backend = cls.from_pretrained(cache_dir=cache_dir, fp16=fp16)
+        try:
+            backend.export(export_dir)
+        except Exception as e:
+            logging.warning(f"Could not export the model to {export_dir}: {e}")
+        return backend
+
+    def export(self, export_dir):
+        """
+        Save the processor config, model config and weights (as safetensors)
+        for from_export().  The export is written next to `export_dir` and
+        renamed into place, so a start that dies half way, or races another,
+        never leaves a partial export behind.
+        """
+        from safetensors.torch import save_file
+
+        timer = _StartupTimer("detr-export-write")
+        partial = f"{export_dir}.partial-{os.getpid()}"
+        os.makedirs(partial, exist_ok=True)
+
+        self.processor.save_pretrained(partial)
+        # The weights in the export include the backbone's
+        config = copy.deepcopy(self.model.config)
+        config.use_pretrained_backbone = False
+        config.save_pretrained(partial)
+        # Cloned so tensors that share storage are saved as tensors of their own
+        save_file(
+            {
+                name: tensor.detach().cpu().contiguous().clone()
+                for name, tensor in self.model.state_dict().items()
+            },
+            os.path.join(partial, WARM_START_WEIGHTS),
+            metadata={"model": DETR_MODEL_NAME, "revision": DETR_MODEL_REVISION},
+        )
+
+        try:
+            os.rename(partial, export_dir)
+        except OSError:
+            # Another start got there first
+            shutil.rmtree(partial, ignore_errors=True)
+        timer.log(export_dir=export_dir)
+
+    @property
+    def accelerated(self):
+        return self.device == "cuda"
+
+    def detect(self, images, threshold=DETECTION_THRESHOLD):
+        from detr import detect_batch
+
+        return detect_batch(
+            self.model,
+            self.processor,
+            self.device,
+            images,
+            fp16=self.fp16,
+            threshold=threshold,
+        )
+
+
+class OnnxBackend:
+    """
+    DETR exported to ONNX, run with ONNX Runtime on the CPU.  Preprocessing
+    and post-processing are numpy versions of DetrImageProcessor's.
+    """
+
+    name = "onnx"
+    accelerated = False
+
+    def __init__(self, model_path, shortest_edge=SHORTEST_EDGE, threads=None):
+        import numpy
+        import onnxruntime
+
+        self.np = numpy
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            model_path, options, providers=["CPUExecutionProvider"]
+        )
+        with open(labels_path(model_path)) as f:
+            self.id2label = {int(k): v for k, v in json.load(f).items()}
+
+        # Smaller inputs trade some accuracy on small objects for speed
+        self.shortest_edge = shortest_edge
+        self.longest_edge = round(LONGEST_EDGE * shortest_edge / SHORTEST_EDGE)
+
+    def _resized_size(self, width, height):
+        """The (width, height) DetrImageProcessor would resize an image to."""
+        size = self.shortest_edge
+        short, long = min(width, height), max(width, height)
+        if long / short * size > self.longest_edge:
+            size = int(round(self.longest_edge * short / long))
+        if short == size:
+            return width, height
+        if width < height:
+            return size, int(size * height / width)
+        return int(size * width / height), size
+
+    def _preprocess(self, images):
+        """Resize, normalise and pad a batch, returning pixels and mask."""
+        np = self.np
+        mean = np.array(IMAGE_MEAN, dtype=np.float32)
+        std = np.array(IMAGE_STD, dtype=np.float32)
+
+        resized = []
+        for image in images:
+            size = self._resized_size(image.width, image.height)
+            pixels = np.asarray(
+                image.convert("RGB").resize(size, PILImage.Resampling.BILINEAR),
+                dtype=np.float32,
+            )
+            resized.append((pixels / 255.0 - mean) / std)
+
+        height = max(pixels.shape[0] for pixels in resized)
+        width = max(pixels.shape[1] for pixels in resized)
+        pixel_values = np.zeros((len(images), 3, height, width), dtype=np.float32)
+        pixel_mask = np.zeros((len(images), height, width), dtype=np.int64)
+        for i, pixels in enumerate(resized):
+            h, w = pixels.shape[:2]
+            pixel_values[i, :, :h, :w] = pixels.transpose(2, 0, 1)
+            pixel_mask[i, :h, :w] = 1
+        return pixel_values, pixel_mask
+
+    def detect(self, images, threshold=DETECTION_THRESHOLD):
+        np = self.np
+        pixel_values, pixel_mask = self._preprocess(images)
+        logits, pred_boxes = self.session.run(
+            ["logits", "pred_boxes"],
+            {"pixel_values": pixel_values, "pixel_mask": pixel_mask},
+        )
+
+        # Softmax over classes, best class per query, ignoring "no object"
+        logits = logits - logits.max(-1, keepdims=True)
+        probs = np.exp(logits)
+        probs /= probs.sum(-1, keepdims=True)
+        probs = probs[..., :-1]
+        scores = probs.max(-1)
+        labels = probs.argmax(-1)
+
+        center_x, center_y, box_w, box_h = np.moveaxis(pred_boxes, -1, 0)
+        boxes = np.stack(
+            [
+                center_x - 0.5 * box_w,
+                center_y - 0.5 * box_h,
+                center_x + 0.5 * box_w,
+                center_y + 0.5 * box_h,
+            ],
+            axis=-1,
+        )
+        sizes = np.array([[image.width, image.height] for image in images])
+        boxes = boxes * np.tile(sizes, 2)[:, None, :]
+
+        packed = np.concatenate([scores[..., None], labels[..., None], boxes], -1)
+        return format_detections(images, packed.tolist(), self.id2label, threshold)
+
+
+def labels_path(model_path):
+    """Where the label names exported alongside an ONNX model are kept."""
+    return os.path.splitext(model_path)[0] + ".labels.json"
+
+
+def load_backend(name=None, **kwargs):
+    """
+    Create the backend named by `name`, or by the INFERENCE_BACKEND
+    environment variable, defaulting to the DETR reference model.
+    """
+    name = name or os.environ.get("INFERENCE_BACKEND", "detr")
+    if name == "detr":
+        return DetrBackend.from_pretrained(**kwargs)
+    if name == "onnx":
+        model_path = kwargs.pop("model_path", None) or os.environ["ONNX_MODEL_PATH"]
+        return OnnxBackend(
+            model_path,
+            shortest_edge=int(os.environ.get("ONNX_SHORTEST_EDGE", SHORTEST_EDGE)),
+            **kwargs,
+        )
+    raise ValueError(f"Unknown inference backend: {name}")
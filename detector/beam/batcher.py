@@ -0,0 +1,118 @@
+"""
+Server-side micro-batching for the inference endpoints.
+
+Concurrent requests hand their images to one MicroBatcher, whose worker
+thread gathers them into batches for the backend: a batch closes when it
+reaches `max_batch_size` images or when its oldest image has waited
+`max_wait_ms`, whichever comes first.  Each caller blocks until the results
+for its own images come back.
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class _Pending:
+    """One image waiting for a batch, and where its result goes."""
+
+    __slots__ = ("image", "future", "enqueued")
+
+    def __init__(self, image):
+        self.image = image
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class MicroBatcher:
+    """Batches images from concurrent callers into calls of `detect`."""
+
+    def __init__(self, detect, max_batch_size=8, max_wait_ms=10):
+        self.detect = detect
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._images = 0
+        self._wait_ms_total = 0.0
+        self._wait_ms_max = 0.0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, images):
+        """Detect objects in `images`, batched with other callers' images."""
+        pending = [_Pending(image) for image in images]
+        for item in pending:
+            self._queue.put(item)
+        return [item.future.result() for item in pending]
+
+    def stats(self):
+        """Queue depth, and batch size and queue wait so far."""
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "batches": self._batches,
+                "images": self._images,
+                "mean_batch_size": self._images / self._batches if self._batches else 0,
+                "mean_wait_ms": (
+                    self._wait_ms_total / self._images if self._images else 0
+                ),
+                "max_wait_ms": self._wait_ms_max,
+            }
+
+    def _gather(self):
+        """Block for the first image, then fill the batch until full or due."""
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # Whatever is already queued joins even when the batch is due;
+            # under backlog the oldest image's deadline has long passed
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._gather()
+            started = time.perf_counter()
+            waits = [(started - item.enqueued) * 1000 for item in batch]
+
+            try:
+                results = self.detect([item.image for item in batch])
+            except Exception as e:
+                for item in batch:
+                    item.future.set_exception(e)
+            else:
+                for item, result in zip(batch, results):
+                    item.future.set_result(result)
+
+            with self._lock:
+                self._batches += 1
+                self._images += len(batch)
+                self._wait_ms_total += sum(waits)
+                self._wait_ms_max = max(self._wait_ms_max, *waits)
+
+            logging.info(
+                json.dumps(
+                    {
+                        "batch_size": len(batch),
+                        "queue_depth": self._queue.qsize(),
+                        "max_wait_ms": round(max(waits), 2),
+                        "inference_ms": round(
+                            (time.perf_counter() - started) * 1000, 2
+                        ),
+                    }
+                )
+            )
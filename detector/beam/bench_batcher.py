@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Synthetic load test for the micro-batcher, on a CPU.
+
+Concurrent clients send single-image requests through a MicroBatcher, first
+with batching off (batches of one) and then with it on, and the script
+compares throughput, latency and the batcher's own statistics.
+
+    python bench_batcher.py --clients 16 --requests 400
+    python bench_batcher.py --backend tiny
+
+The default "sleep" backend needs nothing but Pillow: it costs a fixed time
+per forward pass plus a smaller time per image, like a GPU.  The "tiny"
+backend runs a small randomly initialised DETR with torch.
+"""
+
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image as PILImage
+
+from batcher import MicroBatcher
+
+
+class SleepBackend:
+    """Costs `pass_ms` per call plus `image_ms` per image, then detects nothing."""
+
+    def __init__(self, pass_ms, image_ms):
+        self.pass_seconds = pass_ms / 1000
+        self.image_seconds = image_ms / 1000
+
+    def detect(self, images):
+        time.sleep(self.pass_seconds + self.image_seconds * len(images))
+        return [
+            {"detections": [], "width": image.width, "height": image.height}
+            for image in images
+        ]
+
+
+def tiny_backend():
+    from backends import DetrBackend
+    from detr import tiny_model
+
+    model, processor = tiny_model()
+    return DetrBackend(model, processor, "cpu")
+
+
+def run(backend, clients, requests, max_batch_size, max_wait_ms):
+    """Throughput, latencies and batcher stats for one configuration."""
+    batcher = MicroBatcher(backend.detect, max_batch_size, max_wait_ms)
+    image = PILImage.new("RGB", (320, 180), (90, 90, 90))
+
+    def request(_):
+        start = time.perf_counter()
+        batcher.submit([image])
+        return (time.perf_counter() - start) * 1000
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        latencies = sorted(pool.map(request, range(requests)))
+    wall_seconds = time.perf_counter() - wall_start
+    return requests / wall_seconds, latencies, batcher.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-batcher load test")
+    parser.add_argument("--backend", choices=["sleep", "tiny"], default="sleep")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--pass-ms", type=float, default=40)
+    parser.add_argument("--image-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    if args.backend == "tiny":
+        backend = tiny_backend()
+    else:
+        backend = SleepBackend(args.pass_ms, args.image_ms)
+
+    print(
+        f"{'mode':<10} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'batch':>6} {'wait ms':>8}"
+    )
+    for mode, batch_size, wait_ms in (
+        ("unbatched", 1, 0),
+        ("batched", args.max_batch_size, args.max_wait_ms),
+    ):
+        throughput, latencies, stats = run(
+            backend, args.clients, args.requests, batch_size, wait_ms
+        )
+        print(
+            f"{mode:<10} {throughput:>8.1f} {statistics.median(latencies):>8.1f} "
+            f"{latencies[int(0.95 * (len(latencies) - 1))]:>8.1f} "
+            f"{stats['mean_batch_size']:>6.1f} {stats['mean_wait_ms']:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
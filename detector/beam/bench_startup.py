@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Cold and warm starts of the DETR backend, on a CPU.
+
+Every start runs in a fresh interpreter, so imports are counted too.  The
+first start finds no export, loads the pretrained model through
+from_pretrained and writes the safetensors export; the later ones load the
+export.  Prints the time of each startup phase, and of a first inference.
+
+    python bench_startup.py --export-dir /tmp/detr-warm --starts 3
+    python bench_startup.py --tiny
+
+--tiny exports a tiny, randomly initialised DETR up front, so only warm
+starts are measured and nothing is downloaded.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from PIL import Image as PILImage
+
+from backends import DetrBackend
+
+
+def start(export_dir, cache_dir):
+    """One start, in this process; its phase timings go to stdout."""
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(message)s")
+    begin = time.perf_counter()
+    backend = DetrBackend.from_warm_start(export_dir, cache_dir=cache_dir)
+    loaded = time.perf_counter()
+    backend.detect([PILImage.new("RGB", (640, 360), (90, 90, 90))])
+    print(
+        json.dumps(
+            {
+                "startup": "total",
+                "load_ms": round((loaded - begin) * 1000, 1),
+                "first_inference_ms": round((time.perf_counter() - loaded) * 1000, 1),
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DETR cold and warm starts")
+    parser.add_argument("--export-dir", default="/tmp/detr-warm-start")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--starts", type=int, default=3)
+    parser.add_argument("--tiny", action="store_true")
+    parser.add_argument("--keep", action="store_true", help="reuse an export")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        start(args.export_dir, args.cache_dir)
+        return
+
+    if not args.keep:
+        shutil.rmtree(args.export_dir, ignore_errors=True)
+    if args.tiny:
+        from detr import tiny_model
+
+        model, processor = tiny_model()
+        DetrBackend(model, processor, "cpu").export(args.export_dir)
+
+    command = [sys.executable, __file__, "--child", "--export-dir", args.export_dir]
+    if args.cache_dir:
+        command += ["--cache-dir", args.cache_dir]
+    # Keep the benchmark on the CPU even where there is a GPU
+    env = {**os.environ, "CUDA_VISIBLE_DEVICES": ""}
+
+    for i in range(args.starts):
+        wall_start = time.perf_counter()
+        output = subprocess.run(
+            command, env=env, check=True, capture_output=True, text=True
+        ).stdout
+        wall_ms = (time.perf_counter() - wall_start) * 1000
+        print(f"Start {i + 1}: {wall_ms:.0f} ms including interpreter startup")
+        for line in output.splitlines():
+            if not line.startswith('{"startup"'):
+                continue
+            record = json.loads(line)
+            phases = ", ".join(
+                f"{name[:-3]} {value:.0f}"
+                for name, value in record.items()
+                if name.endswith("_ms")
+            )
+            print(f"  {record['startup']:<18} {phases} (ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Compare ONNX models against the PyTorch DETR reference on a folder of sample
+frames, for accuracy and latency.
+
+    python compare_backends.py --frames samples/ \
+        --onnx models/detr.onnx models/detr.int8.onnx
+
+Each candidate's detections are matched to the reference's by label and IoU.
+The script reports precision and recall against the reference, the mean IoU
+and confidence difference of matched boxes, and the median and p95 latency
+per frame for every backend.
+"""
+
+import argparse
+import glob
+import os
+import statistics
+import time
+
+from PIL import Image as PILImage
+
+from backends import DetrBackend, OnnxBackend
+
+
+def iou(a, b):
+    """Intersection over union of two detection boxes."""
+    a, b = a["box"], b["box"]
+    width = min(a["xMax"], b["xMax"]) - max(a["xMin"], b["xMin"])
+    height = min(a["yMax"], b["yMax"]) - max(a["yMin"], b["yMin"])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    area_a = (a["xMax"] - a["xMin"]) * (a["yMax"] - a["yMin"])
+    area_b = (b["xMax"] - b["xMin"]) * (b["yMax"] - b["yMin"])
+    return intersection / (area_a + area_b - intersection)
+
+
+def match(reference, candidate, min_iou):
+    """
+    Greedily pair candidate detections with reference detections of the same
+    label, best IoU first.  Returns the list of (reference, candidate) pairs.
+    """
+    pairs = sorted(
+        (
+            (iou(r, c), i, j)
+            for i, r in enumerate(reference)
+            for j, c in enumerate(candidate)
+            if r["label"] == c["label"]
+        ),
+        reverse=True,
+    )
+    used_reference, used_candidate, matched = set(), set(), []
+    for overlap, i, j in pairs:
+        if overlap < min_iou:
+            break
+        if i in used_reference or j in used_candidate:
+            continue
+        used_reference.add(i)
+        used_candidate.add(j)
+        matched.append((reference[i], candidate[j]))
+    return matched
+
+
+def run(backend, images, iterations):
+    """Detections for every image, and the per-image latencies in ms."""
+    backend.detect(images[:1])  # warm up
+    results, timings = [], []
+    for image in images:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            result = backend.detect([image])[0]
+            timings.append((time.perf_counter() - start) * 1000)
+        results.append(result["detections"])
+    return results, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare inference backends")
+    parser.add_argument("--frames", required=True, help="folder of sample JPEGs")
+    parser.add_argument("--onnx", nargs="+", required=True, help="ONNX models")
+    parser.add_argument("--cache-dir", default="./weights")
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--min-iou", type=float, default=0.5)
+    parser.add_argument("--threads", type=int, help="ONNX Runtime intra-op threads")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.frames, "*.jpg")))
+    if not paths:
+        parser.error(f"No .jpg frames in {args.frames}")
+    images = [PILImage.open(path).convert("RGB") for path in paths]
+    print(f"Comparing on {len(images)} frames, {args.iterations} runs each")
+
+    reference = DetrBackend.from_pretrained(cache_dir=args.cache_dir)
+    reference_results, reference_timings = run(reference, images, args.iterations)
+
+    rows = [(f"detr ({reference.device})", None, reference_timings)]
+    for model_path in args.onnx:
+        backend = OnnxBackend(model_path, threads=args.threads)
+        results, timings = run(backend, images, args.iterations)
+        rows.append((os.path.basename(model_path), results, timings))
+
+    print()
+    print(
+        f"{'backend':<24} {'median ms':>10} {'p95 ms':>10} {'precision':>10} "
+        f"{'recall':>8} {'mean IoU':>9} {'mean dconf':>11}"
+    )
+    for name, candidate, timings in rows:
+        timings.sort()
+        latency = (
+            f"{statistics.median(timings):>10.1f} "
+            f"{timings[int(0.95 * (len(timings) - 1))]:>10.1f}"
+        )
+        if candidate is None:
+            print(f"{name:<24} {latency} {'reference':>10}")
+            continue
+
+        matched = []
+        for ref, cand in zip(reference_results, candidate):
+            matched.extend(match(ref, cand, args.min_iou))
+        found = sum(len(c) for c in candidate)
+        expected = sum(len(r) for r in reference_results)
+        precision = len(matched) / found if found else 1.0
+        recall = len(matched) / expected if expected else 1.0
+        mean_iou = statistics.fmean(iou(r, c) for r, c in matched) if matched else 0
+        mean_dconf = (
+            statistics.fmean(abs(r["confidence"] - c["confidence"]) for r, c in matched)
+            if matched
+            else 0
+        )
+        print(
+            f"{name:<24} {latency} {precision:>10.3f} {recall:>8.3f} "
+            f"{mean_iou:>9.3f} {mean_dconf:>11.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
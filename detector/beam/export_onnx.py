@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Export the DETR reference model to ONNX for the "onnx" inference backend,
+optionally with a dynamically quantized int8 copy.
+
+    python export_onnx.py --output models/detr.onnx --quantize
+
+writes models/detr.onnx, models/detr.int8.onnx and a .labels.json next to
+each.  Point ONNX_MODEL_PATH at either model to serve it.
+"""
+
+import argparse
+import json
+import os
+import shutil
+
+import torch
+
+from backends import DetrBackend, labels_path
+
+
+class DetrOutputs(torch.nn.Module):
+    """DETR returning plain (logits, pred_boxes) tensors, as ONNX needs."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values, pixel_mask):
+        outputs = self.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+        return outputs.logits, outputs.pred_boxes
+
+
+def export(model, output_path, opset):
+    """Export with dynamic batch and image size, and save the label names."""
+    model.to("cpu").eval()
+    pixel_values = torch.randn(1, 3, 800, 1066)
+    pixel_mask = torch.ones(1, 800, 1066, dtype=torch.int64)
+    torch.onnx.export(
+        DetrOutputs(model),
+        (pixel_values, pixel_mask),
+        output_path,
+        input_names=["pixel_values", "pixel_mask"],
+        output_names=["logits", "pred_boxes"],
+        dynamic_axes={
+            "pixel_values": {0: "batch", 2: "height", 3: "width"},
+            "pixel_mask": {0: "batch", 1: "height", 2: "width"},
+            "logits": {0: "batch"},
+            "pred_boxes": {0: "batch"},
+        },
+        opset_version=opset,
+    )
+    with open(labels_path(output_path), "w") as f:
+        json.dump(model.config.id2label, f)
+
+
+def quantize(model_path, output_path):
+    """Quantize the weights of MatMul/Gemm layers to int8."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(
+        model_path,
+        output_path,
+        op_types_to_quantize=["MatMul", "Gemm"],
+        weight_type=QuantType.QInt8,
+    )
+    shutil.copyfile(labels_path(model_path), labels_path(output_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export DETR to ONNX")
+    parser.add_argument("--output", default="models/detr.onnx")
+    parser.add_argument("--cache-dir", default="./weights")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="also write a dynamically quantized int8 model",
+    )
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+
+    backend = DetrBackend.from_pretrained(cache_dir=args.cache_dir)
+    export(backend.model, args.output, args.opset)
+    print(f"Wrote {args.output}")
+
+    if args.quantize:
+        quantized_path = os.path.splitext(args.output)[0] + ".int8.onnx"
+        quantize(args.output, quantized_path)
+        print(f"Wrote {quantized_path}")
+
+
+if __name__ == "__main__":
+    main()
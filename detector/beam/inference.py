@@ -1,42 +1,74 @@
 #!/usr/bin/env python3
 
 import os
-from beam import Image, endpoint, env, Volume
+from beam import Image, endpoint, task_queue, Volume
 import subprocess
 import boto3
-import tempfile
+import io
+import base64
+import json
 import logging
 from PIL import Image as PILImage
 import jwt
+from backends import DetrBackend, OnnxBackend, warm_start_dir
+from batcher import MicroBatcher
+
 
 # Path to cache model weights
 BEAM_VOLUME_CACHE_PATH = "./weights"
 
-if env.is_remote():
-    from transformers import DetrImageProcessor, DetrForObjectDetection
-    import torch
+S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME", "atx-traffic-cameras")
+
+# Images from concurrent requests are gathered into batches of up to this
+# many (which also bounds GPU memory), waiting at most this long for a batch
+# to fill
+INFERENCE_BATCH_SIZE = int(os.environ.get("INFERENCE_BATCH_SIZE", 8))
+INFERENCE_BATCH_WAIT_MS = float(os.environ.get("INFERENCE_BATCH_WAIT_MS", 10))
+# Requests each container serves at once, so there is something to batch
+INFERENCE_CONCURRENT_REQUESTS = int(os.environ.get("INFERENCE_CONCURRENT_REQUESTS", 16))
+# Run the forward pass under float16 autocast when on a GPU
+INFERENCE_FP16 = os.environ.get("INFERENCE_FP16", "true").lower() == "true"
+# Start from the safetensors export on the weights volume, written by the
+# first start, instead of going through from_pretrained every time
+INFERENCE_WARM_START = os.environ.get("INFERENCE_WARM_START", "true").lower() == "true"
+
+# The exported model served by the CPU endpoint, see export_onnx.py
+ONNX_MODEL_PATH = os.environ.get(
+    "ONNX_MODEL_PATH", os.path.join(BEAM_VOLUME_CACHE_PATH, "onnx", "detr.int8.onnx")
+)
 
 
 # Function to download and cache models
 def download_models():
     # Initialize the object detection model and processor
-    processor = DetrImageProcessor.from_pretrained(
-        "facebook/detr-resnet-101",
-        revision="no_timm",
-        cache_dir=BEAM_VOLUME_CACHE_PATH,
-    )
-    model = DetrForObjectDetection.from_pretrained(
-        "facebook/detr-resnet-101",
-        revision="no_timm",
-        cache_dir=BEAM_VOLUME_CACHE_PATH,
+    if INFERENCE_WARM_START:
+        backend = DetrBackend.from_warm_start(
+            warm_start_dir(BEAM_VOLUME_CACHE_PATH),
+            cache_dir=BEAM_VOLUME_CACHE_PATH,
+            fp16=INFERENCE_FP16,
+        )
+    else:
+        backend = DetrBackend.from_pretrained(
+            cache_dir=BEAM_VOLUME_CACHE_PATH, fp16=INFERENCE_FP16
+        )
+    logging.info(f"Using device: {backend.device}")
+    return backend, _batcher(backend)
+
+
+# Load the exported model for CPU-only workers
+def load_onnx_model():
+    backend = OnnxBackend(ONNX_MODEL_PATH)
+    logging.info(f"Using ONNX model: {ONNX_MODEL_PATH}")
+    return backend, _batcher(backend)
+
+
+def _batcher(backend):
+    return MicroBatcher(
+        backend.detect,
+        max_batch_size=INFERENCE_BATCH_SIZE,
+        max_wait_ms=INFERENCE_BATCH_WAIT_MS,
     )
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model.to(device)
-    logging.info(f"Using device: {device}")
-
-    return model, processor, device
-
 
 @endpoint(
     cpu=1.0,
@@ -64,6 +96,7 @@ def nvidia_smi_endpoint(**inputs):
     memory=8,
     gpu="T4",
     on_start=download_models,
+    concurrent_requests=INFERENCE_CONCURRENT_REQUESTS,
     volumes=[Volume(name="weights", mount_path=BEAM_VOLUME_CACHE_PATH)],
     secrets=["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "JWT_SHARED_SECRET"],
     image=Image(python_version="python3.12").add_python_packages(
@@ -71,6 +104,7 @@ def nvidia_smi_endpoint(**inputs):
             "transformers",
             "torch",
             "huggingface_hub[hf-transfer]",
+            "safetensors",
             "Pillow",
             "boto3",
             "PyJWT",
@@ -78,76 +112,140 @@ def nvidia_smi_endpoint(**inputs):
     ),
 )
 def object_detection_endpoint(context, **inputs):
-    model, processor, device = context.on_start_value
+    backend, batcher = context.on_start_value
+    return detect_request(backend, batcher, inputs)
 
-    aws_access_key_id = os.environ["AWS_ACCESS_KEY_ID"]
-    aws_secret_access_key = os.environ["AWS_SECRET_ACCESS_KEY"]
-    jwt_shared_secret = os.environ["JWT_SHARED_SECRET"]
 
+@endpoint(
+    cpu=4.0,
+    memory=4,
+    on_start=load_onnx_model,
+    concurrent_requests=INFERENCE_CONCURRENT_REQUESTS,
+    volumes=[Volume(name="weights", mount_path=BEAM_VOLUME_CACHE_PATH)],
+    secrets=["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "JWT_SHARED_SECRET"],
+    image=Image(python_version="python3.12").add_python_packages(
+        ["onnxruntime", "numpy", "Pillow", "boto3", "PyJWT"]
+    ),
+)
+def cpu_object_detection_endpoint(context, **inputs):
+    backend, batcher = context.on_start_value
+    return detect_request(backend, batcher, inputs)
+
+
+@task_queue(
+    cpu=1.0,
+    memory=8,
+    gpu="T4",
+    on_start=download_models,
+    retries=2,
+    volumes=[Volume(name="weights", mount_path=BEAM_VOLUME_CACHE_PATH)],
+    secrets=["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "JWT_SHARED_SECRET"],
+    image=Image(python_version="python3.12").add_python_packages(
+        [
+            "transformers",
+            "torch",
+            "huggingface_hub[hf-transfer]",
+            "safetensors",
+            "Pillow",
+            "boto3",
+            "PyJWT",
+        ]
+    ),
+)
+def object_detection_task(context, **inputs):
+    backend, batcher = context.on_start_value
+    return detect_job(backend, batcher, inputs)
+
+
+def _authenticate(inputs):
+    """The claims of the request's JWT, or None and an error response."""
+    jwt_shared_secret = os.environ["JWT_SHARED_SECRET"]
     try:
         jwt_token = inputs["jwt"]
-        decoded_jwt = jwt.decode(jwt_token, jwt_shared_secret, algorithms=["HS256"])
-        key = decoded_jwt["key"]
+        return jwt.decode(jwt_token, jwt_shared_secret, algorithms=["HS256"]), None
     except KeyError:
-        return {"error": "JWT not provided"}
+        return None, {"error": "JWT not provided"}
     except jwt.PyJWTError as e:
-        return {"error": f"Invalid JWT: {e}"}
+        return None, {"error": f"Invalid JWT: {e}"}
 
-    s3 = boto3.client(
+
+def _s3_client():
+    return boto3.client(
         "s3",
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
+        aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
+        aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
     )
 
-    bucket_name = "atx-traffic-cameras"
-
-    detections = []
-    with tempfile.NamedTemporaryFile() as tmp_file:
-        s3.download_file(bucket_name, key, tmp_file.name)
-        image_path = tmp_file.name
-
-        image = PILImage.open(image_path)
-        width, height = image.size
-
-        # Process the image for object detection
-        processed_inputs = processor(images=image, return_tensors="pt")
-        processed_inputs = processed_inputs.to(device)
-        outputs = model(**processed_inputs)
-
-        # Convert outputs to COCO API format and filter with threshold
-        target_sizes = torch.tensor([image.size[::-1]]).to(device)
-        results = processor.post_process_object_detection(
-            outputs, target_sizes=target_sizes, threshold=0.6
-        )[0]
-
-        # Prepare detection results
-        for score, label, box in zip(
-            results["scores"], results["labels"], results["boxes"]
-        ):
-            box = [round(i, 2) for i in box.tolist()]
-            label_name = model.config.id2label[label.item()]
-            confidence = round(score.item(), 3)
-
-            logging.info(
-                f"Detected {label_name} with confidence {confidence} at location {box}"
-            )
-
-            detections.append(
-                {
-                    "label": label_name,
-                    "confidence": confidence,
-                    "box": {
-                        "xMin": box[0],
-                        "yMin": box[1],
-                        "xMax": box[2],
-                        "yMax": box[3],
-                    },
-                }
-            )
 
+def _detect(backend, batcher, s3, keys, inputs):
+    """Detect objects in the frames at `keys`, batched by `batcher`."""
+    # The caller may send the frames inline; anything else is read from S3
+    # straight into memory
+    inline_images = inputs.get("images") or {}
+
+    images = []
+    for key in keys:
+        if key in inline_images:
+            image_bytes = base64.b64decode(inline_images[key])
+        else:
+            image_bytes = s3.get_object(Bucket=S3_BUCKET_NAME, Key=key)["Body"].read()
+        images.append(PILImage.open(io.BytesIO(image_bytes)).convert("RGB"))
+
+    results = batcher.submit(images)
+    for key, result in zip(keys, results):
+        result["key"] = key
+        result["torch_cuda_available"] = backend.accelerated
+        logging.info(f"Detected {len(result['detections'])} objects in {key}")
+    return results
+
+
+def detect_request(backend, batcher, inputs):
+    """
+    Authenticate a detection request and run its images through `backend`,
+    batched by `batcher` with those of concurrent requests.
+    """
+    # The JWT names either a single image ("key") or a batch ("keys")
+    decoded_jwt, error = _authenticate(inputs)
+    if error:
+        return error
+    try:
+        keys = decoded_jwt["keys"] if "keys" in decoded_jwt else [decoded_jwt["key"]]
+    except KeyError:
+        return {"error": "JWT not provided"}
+
+    results = _detect(backend, batcher, _s3_client(), keys, inputs)
+
+    if "keys" not in decoded_jwt:
+        return results[0]
     return {
-        "detections": detections,
-        "torch_cuda_available": device == "cuda",
-        "width": width,
-        "height": height,
+        "results": results,
+        "torch_cuda_available": backend.accelerated,
+        "batcher": batcher.stats(),
     }
+
+
+def detect_job(backend, batcher, inputs):
+    """
+    Run an asynchronous detection job.  Its JWT names the frames ("keys") and
+    the S3 key each frame's result is written to ("result_keys"); the S3
+    notification for that object hands the result back to the detector.
+    """
+    decoded_jwt, error = _authenticate(inputs)
+    if error:
+        logging.error(error["error"])
+        return error
+    keys = decoded_jwt["keys"]
+    result_keys = decoded_jwt["result_keys"]
+
+    s3 = _s3_client()
+    results = _detect(backend, batcher, s3, keys, inputs)
+    for key, result in zip(keys, results):
+        result["job"] = decoded_jwt.get("job")
+        s3.put_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=result_keys[key],
+            Body=json.dumps(result).encode(),
+            ContentType="application/json",
+        )
+    logging.info(f"Wrote {len(results)} results for job {decoded_jwt.get('job')}")
+    return {"written": [result_keys[key] for key in keys]}
@@ -0,0 +1,51 @@
+"""
+Crop atlases.
+
+In atlas storage all the crops of one frame live in a single S3 object, their
+JPEGs concatenated.  A Detection's `picture` is then the atlas key, and
+`pictureOffset` and `pictureLength` give the byte range of its own crop, so
+any one crop can be read back with a range GET and is a complete JPEG.
+Crops stored as objects of their own have no range.
+"""
+
+ATLAS_CONTENT_TYPE = "application/octet-stream"
+
+
+def pack(crops):
+    """
+    Concatenate encoded crops into one atlas body.  Returns the body and the
+    (offset, length) of each crop in it, in order.
+    """
+    ranges = []
+    offset = 0
+    for crop in crops:
+        ranges.append((offset, len(crop)))
+        offset += len(crop)
+    return b"".join(crops), ranges
+
+
+def read_crop(s3_client, bucket, picture, offset=None, length=None):
+    """
+    The JPEG bytes of one crop: a range GET of its atlas when `offset` and
+    `length` are given, otherwise the whole object.
+    """
+    if offset is None or length is None:
+        response = s3_client.get_object(Bucket=bucket, Key=picture)
+    else:
+        response = s3_client.get_object(
+            Bucket=bucket,
+            Key=picture,
+            Range=f"bytes={offset}-{offset + length - 1}",
+        )
+    return response["Body"].read()
+
+
+def read_detection_crop(s3_client, bucket, detection):
+    """The crop of a Detection row, wherever it is stored."""
+    return read_crop(
+        s3_client,
+        bucket,
+        detection.picture,
+        detection.pictureOffset,
+        detection.pictureLength,
+    )
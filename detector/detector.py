@@ -1,90 +1,666 @@
+import time
+
+# Taken before anything else is imported, for STARTUP_PROFILE
+_import_started = time.perf_counter()
+
 import json
 import os
 import re
+import sys
 import jwt
-import requests
-from prisma import Prisma
-import boto3
+import base64
+import functools
 import hashlib
-from PIL import Image as PILImage
 import io
+import math
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from urllib.parse import unquote_plus
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from crops import ATLAS_CONTENT_TYPE, pack
+from startup import get_db, reset_db, startup_timings, timed_init
 
+# boto3, requests, Pillow, NumPy (with georeference.py), the inference
+# backends and Prisma are imported on first use, so an invocation that has
+# nothing to do, like a redelivered notification, doesn't pay for them.
 
-db = Prisma()
-db.connect()
 
+# Crops of one frame are encoded and uploaded concurrently, at most this many
+# at a time.  The S3 client's connection pool is sized to match.
+CROP_UPLOAD_WORKERS = int(os.environ.get("CROP_UPLOAD_WORKERS", 16))
+# "atlas" stores all the crops of a frame as one object, each detection
+# recording its byte range (see crops.py); "objects" stores one per crop
+CROP_STORAGE = os.environ.get("CROP_STORAGE", "atlas")
 
-def handler(event, context):
+# Where detection runs: "remote" calls the Beam endpoint, "async" submits a
+# job to the Beam task queue without waiting for it (see results_handler),
+# "onnx" runs the exported model (ONNX_MODEL_PATH) on this Lambda's CPU
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "remote")
+# The remote endpoint's connect and read timeouts.  A stalled endpoint fails
+# the batch's messages, for SQS to redeliver, well before the Lambda times out.
+INFERENCE_CONNECT_TIMEOUT_SECONDS = float(
+    os.environ.get("INFERENCE_CONNECT_TIMEOUT", 5)
+)
+INFERENCE_READ_TIMEOUT_SECONDS = float(os.environ.get("INFERENCE_READ_TIMEOUT", 60))
+
+# Asynchronous jobs write each frame's result under this prefix, and the S3
+# notifications for those objects invoke results_handler.  A frame whose
+# result hasn't been ingested this long after submission is resubmitted by
+# sweep_handler, up to INFERENCE_JOB_MAX_ATTEMPTS submissions in all.
+INFERENCE_RESULTS_PREFIX = os.environ.get(
+    "INFERENCE_RESULTS_PREFIX", "inference-results/"
+)
+INFERENCE_JOB_TIMEOUT_SECONDS = int(os.environ.get("INFERENCE_JOB_TIMEOUT", 600))
+INFERENCE_JOB_MAX_ATTEMPTS = int(os.environ.get("INFERENCE_JOB_MAX_ATTEMPTS", 3))
+# Most frames one sweep resubmits
+INFERENCE_SWEEP_LIMIT = int(os.environ.get("INFERENCE_SWEEP_LIMIT", 100))
+# Submitting a job only enqueues it, so don't wait long on the task queue
+INFERENCE_SUBMIT_TIMEOUT_SECONDS = float(os.environ.get("INFERENCE_SUBMIT_TIMEOUT", 10))
+
+# Similarity gate: a frame whose luminance grid differs from its camera's
+# last inferred frame by at most this much in every cell (on a 0-255 scale)
+# reuses that frame's detections instead of running inference.  The largest
+# cell difference is used, not the mean, so one new vehicle isn't averaged
+# away over the whole frame.  Off (0) until tuned against real frames.
+SIMILARITY_THRESHOLD = float(os.environ.get("SIMILARITY_THRESHOLD", 0))
+# Run inference on every camera at least this often, however static the scene
+SIMILARITY_MAX_AGE_SECONDS = int(os.environ.get("SIMILARITY_MAX_AGE_SECONDS", 900))
+SIGNATURE_SIZE = (16, 16)
+
+# How long an invocation may hold an image before another may take it over.
+# Should comfortably exceed the Lambda timeout.
+DETECTION_LEASE_SECONDS = int(os.environ.get("DETECTION_LEASE_SECONDS", 900))
+
+# Namespace for detection ids derived from image hashes and detection content
+DETECTION_ID_NAMESPACE = uuid.UUID("5b1f7c1e-3c2a-4d59-9f4b-2f8d6a0e7c41")
+
+# CloudWatch namespace for the per-invocation metrics the handler logs
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "TrafficCameras/Detector")
+# Units of the counters that aren't plain counts; anything ending in _ms,
+# like every stage timing, is in milliseconds
+COUNTER_UNITS = {"bytes_downloaded": "Bytes", "bytes_uploaded": "Bytes"}
+
+# STARTUP_PROFILE=true logs, after the first invocation of an execution
+# environment, how long importing this module took and how long each lazily
+# initialised dependency took to import and set up.  Set
+# PYTHONPROFILEIMPORTTIME=1 as well for a breakdown of every import.
+STARTUP_PROFILE = os.environ.get("STARTUP_PROFILE", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# Created once per execution environment and shared by the upload threads,
+# under a lock since those threads may be the first to ask for it
+_s3_client = None
+_s3_client_lock = threading.Lock()
+# The local inference backend, loaded on first use
+_backend = None
+
+# Whether the startup profile has been logged yet
+_startup_reported = False
+
+
+def _entry_point(handler):
     """
-    Main Lambda handler function
-    Parameters:
-        event: Dict containing the Lambda function event data
-        context: Lambda runtime context
-    Returns:
-        Dict compatible with Lambda Function URL / API Gateway
+    Wrap a Lambda entry point: drop the database connection when it fails,
+    so the next invocation reconnects, and log the startup profile after the
+    first invocation when STARTUP_PROFILE is on.
     """
-    # print("Received event: " + json.dumps(event, indent=2)) # keep this comment
 
-    key = event["Records"][0]["s3"]["object"]["key"]
-    bucket = event["Records"][0]["s3"]["bucket"]["name"]
-    print(f"Received key: {key} from bucket: {bucket}")
-
-    match = re.search(r"([^/]+)\.jpg$", key)
-    if not match:
-        print(f"Could not extract image hash from key: {key}")
-        return {
-            "statusCode": 400,
-            "body": json.dumps(
-                {"message": f"Could not extract image hash from key: {key}"}
-            ),
-        }
-    image_hash = match.group(1)
-    print(f"Extracted image_hash: {image_hash}")
-
-    image = db.image.find_unique(where={"hash": image_hash}, include={"camera": True})
-    if not image:
-        print(f"Image with hash {image_hash} not found in database.")
-        return {
-            "statusCode": 404,
-            "body": json.dumps({"message": f"Image with hash {image_hash} not found."}),
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _startup_reported
+        start = time.perf_counter()
+        try:
+            return handler(event, context)
+        except Exception as e:
+            reset_db(e)
+            raise
+        finally:
+            if STARTUP_PROFILE and not _startup_reported:
+                _startup_reported = True
+                profile = {
+                    "entry_point": handler.__name__,
+                    **startup_timings,
+                    "first_invocation_ms": round(
+                        (time.perf_counter() - start) * 1000, 2
+                    ),
+                    "loaded": [
+                        name
+                        for name in ("boto3", "requests", "PIL", "numpy", "prisma")
+                        if name in sys.modules
+                    ],
+                }
+                print(json.dumps({"startup_profile": profile}))
+
+    return wrapper
+
+
+class _Metrics:
+    """
+    Stage timings and counters for one invocation, logged as a single
+    CloudWatch embedded metric format (EMF) JSON line.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+        self._start = self._last = time.perf_counter()
+
+    def lap(self, stage):
+        """Charge the time since the previous lap to `stage`."""
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0) + (now - self._last) * 1000
+        self._last = now
+
+    def add(self, counter, value=1):
+        """Add to a counter; safe to call from the upload threads."""
+        with self._lock:
+            self.counters[counter] += value
+
+    def emit(self):
+        self.timings["total"] = (time.perf_counter() - self._start) * 1000
+        timings = {f"{stage}_ms": round(ms, 2) for stage, ms in self.timings.items()}
+        counters = {name: round(value, 2) for name, value in self.counters.items()}
+        definitions = [
+            {
+                "Name": name,
+                "Unit": (
+                    "Milliseconds"
+                    if name.endswith("_ms")
+                    else COUNTER_UNITS.get(name, "Count")
+                ),
+            }
+            for name in {**timings, **counters}
+        ]
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": METRICS_NAMESPACE,
+                        "Dimensions": [[]],
+                        "Metrics": definitions,
+                    }
+                ],
+            },
+            **timings,
+            **counters,
         }
+        print(json.dumps(record))
 
-    jwt_shared_secret = os.environ["JWT_SHARED_SECRET"]
-    payload = {"key": key}
-    encoded_jwt = jwt.encode(payload, jwt_shared_secret, algorithm="HS256")
 
-    url = os.environ["DETECTOR_BEAM_LAMBDA"]
-    beam_token = os.environ.get("BEAM_TOKEN")
+def _parse_records(event):
+    """
+    Return one item per S3 object in the event, whether the S3 notification
+    invoked us directly or arrived wrapped in SQS messages.  Each item is a
+    dict with the SQS message id (None for direct invocations), bucket and key.
+    Records that aren't S3 notifications are logged and dropped, so one bad
+    message doesn't fail the rest of the batch.
+    """
+    items = []
+    for record in event.get("Records", []):
+        try:
+            if record.get("eventSource") == "aws:sqs":
+                notification = json.loads(record["body"])
+                receive_count = int(
+                    record.get("attributes", {}).get("ApproximateReceiveCount", 1)
+                )
+                # S3 sends an s3:TestEvent without records when a queue is
+                # wired up
+                items.extend(
+                    [
+                        {
+                            "message_id": record["messageId"],
+                            "receive_count": receive_count,
+                            "bucket": s3_record["s3"]["bucket"]["name"],
+                            "key": unquote_plus(s3_record["s3"]["object"]["key"]),
+                        }
+                        for s3_record in notification.get("Records", [])
+                    ]
+                )
+            else:
+                items.append(
+                    {
+                        "message_id": None,
+                        "receive_count": 1,
+                        "bucket": record["s3"]["bucket"]["name"],
+                        "key": unquote_plus(record["s3"]["object"]["key"]),
+                    }
+                )
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # Retrying can't fix a malformed message, so drop it
+            print(f"Dropping malformed record {record.get('messageId')}: {e!r}")
+    return items
+
+
+def _fetch_image(item):
+    """
+    Read the uploaded frame from S3 into memory, once per invocation.
+    Returns None if it can't be read.
+    """
+    try:
+        s3_response = _get_s3_client().get_object(
+            Bucket=item["bucket"], Key=item["key"]
+        )
+        return s3_response["Body"].read()
+    except Exception as e:
+        print(f"Error reading {item['key']} from S3: {e}")
+        return None
 
+
+def _fetch_images(items):
+    """
+    Read every item's frame from S3 concurrently.  Returns the bytes of the
+    frames that could be read, by key.
+    """
+    if not items:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(CROP_UPLOAD_WORKERS, len(items))) as pool:
+        fetched = pool.map(_fetch_image, items)
+        return {item["key"]: body for item, body in zip(items, fetched) if body}
+
+
+def _beam_headers():
     headers = {
         "Content-Type": "application/json",
     }
 
+    beam_token = os.environ.get("BEAM_TOKEN")
     if beam_token:
         headers["Authorization"] = f"Bearer {beam_token}"
+    return headers
 
-    data = {"jwt": encoded_jwt}
 
-    print(f"Calling endpoint with JWT: {encoded_jwt}")
+def _requests():
+    """requests, imported on first use."""
+    with timed_init("requests"):
+        import requests
+    return requests
 
-    response = requests.post(url, headers=headers, json=data)
+
+def _call_inference(keys, image_bytes):
+    """
+    Send every key to the inference endpoint in one request, along with the
+    frames themselves so the endpoint doesn't have to fetch them again.
+    """
+    jwt_shared_secret = os.environ["JWT_SHARED_SECRET"]
+    payload = {"keys": keys}
+    encoded_jwt = jwt.encode(payload, jwt_shared_secret, algorithm="HS256")
+
+    url = os.environ["DETECTOR_BEAM_LAMBDA"]
+    headers = _beam_headers()
+
+    data = {
+        "jwt": encoded_jwt,
+        "images": {
+            key: base64.b64encode(image_bytes[key]).decode("ascii") for key in keys
+        },
+    }
+
+    print(f"Calling endpoint for {len(keys)} images with JWT: {encoded_jwt}")
+
+    response = _requests().post(
+        url,
+        headers=headers,
+        json=data,
+        timeout=(INFERENCE_CONNECT_TIMEOUT_SECONDS, INFERENCE_READ_TIMEOUT_SECONDS),
+    )
 
     # print("Received response: " + response.text)
 
     response_json = json.loads(response.text)
-    detections = response_json["detections"]
-    print(f"Found {len(detections)} detections.")
+    if "error" in response_json:
+        raise RuntimeError(f"Inference endpoint error: {response_json['error']}")
+    return {result["key"]: result for result in response_json["results"]}
+
+
+def _result_key(image, job):
+    """
+    The S3 key a job writes the image's result to.  Each job writes its own,
+    so a late result can't overwrite a newer job's.
+    """
+    return f"{INFERENCE_RESULTS_PREFIX}{image.hash}/{job}.json"
+
+
+def _submit_inference_job(items, images, image_bytes=None):
+    """
+    Submit the frames to the inference task queue as one job, without
+    waiting for it to run.  Each image records the job, and its lease is
+    extended to INFERENCE_JOB_TIMEOUT_SECONDS so no one else takes it while
+    the job is outstanding.  Frames in `image_bytes` are sent along, so the
+    worker doesn't read them from S3 again.
+    """
+    job = uuid.uuid4().hex
+    now = datetime.now(timezone.utc)
+    with get_db().batch_() as batcher:
+        for item in items:
+            batcher.image.update(
+                where={"id": images[item["image_hash"]].id},
+                data={
+                    "inferenceJobKey": item["key"],
+                    "inferenceJobId": job,
+                    "inferenceJobAt": now,
+                    "inferenceJobAttempts": {"increment": 1},
+                    "detectionLeaseUntil": now
+                    + timedelta(seconds=INFERENCE_JOB_TIMEOUT_SECONDS),
+                },
+            )
+
+    keys = [item["key"] for item in items]
+    payload = {
+        "keys": keys,
+        "result_keys": {
+            item["key"]: _result_key(images[item["image_hash"]], job) for item in items
+        },
+        "job": job,
+    }
+    encoded_jwt = jwt.encode(
+        payload, os.environ["JWT_SHARED_SECRET"], algorithm="HS256"
+    )
+    image_bytes = image_bytes or {}
+    response = _requests().post(
+        os.environ["DETECTOR_BEAM_TASK_QUEUE"],
+        headers=_beam_headers(),
+        json={
+            "jwt": encoded_jwt,
+            "images": {
+                key: base64.b64encode(image_bytes[key]).decode("ascii")
+                for key in keys
+                if key in image_bytes
+            },
+        },
+        timeout=INFERENCE_SUBMIT_TIMEOUT_SECONDS,
+    )
+    response.raise_for_status()
+    print(
+        f"Submitted job {payload['job']} (task {response.json().get('task_id')}) "
+        f"for {len(keys)} images."
+    )
+
+
+def _run_inference(keys, image_bytes):
+    """Detect objects in every frame, remotely or in process."""
+    if INFERENCE_BACKEND == "remote":
+        return _call_inference(keys, image_bytes)
+
+    from PIL import Image as PILImage
+
+    global _backend
+    if _backend is None:
+        with timed_init("backend"):
+            from backends import load_backend
+
+            _backend = load_backend(INFERENCE_BACKEND)
+
+    # On a CPU, padding frames into one batch only adds work
+    results = {}
+    for key in keys:
+        image = PILImage.open(io.BytesIO(image_bytes[key])).convert("RGB")
+        results[key] = _backend.detect([image])[0]
+    print(f"Ran {INFERENCE_BACKEND} inference on {len(keys)} images.")
+    return results
+
+
+def _get_s3_client():
+    """Return the shared S3 client, sized for the crop upload pool."""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                with timed_init("boto3"):
+                    import boto3
+                    from botocore.config import Config
+
+                    _s3_client = boto3.client(
+                        "s3",
+                        config=Config(max_pool_connections=CROP_UPLOAD_WORKERS),
+                    )
+    return _s3_client
+
+
+def _frame_signature(image_bytes):
+    """
+    A compact signature of the frame: its luminance downsampled to a 16x16
+    grid, as hex.  Draft mode lets the JPEG decoder do most of the scaling.
+    Returns None if the frame can't be decoded.
+    """
+    from PIL import Image as PILImage
+
+    try:
+        img = PILImage.open(io.BytesIO(image_bytes))
+        img.draft("L", SIGNATURE_SIZE)
+        grid = img.convert("L").resize(SIGNATURE_SIZE, PILImage.Resampling.BOX)
+        return grid.tobytes().hex()
+    except Exception as e:
+        print(f"Error computing frame signature: {e}")
+        return None
+
+
+def _signature_distance(a, b):
+    """Largest luminance difference of any one cell of two frame signatures."""
+    if not a or not b or len(a) != len(b):
+        return math.inf
+    a, b = bytes.fromhex(a), bytes.fromhex(b)
+    return max(abs(x - y) for x, y in zip(a, b))
+
+
+def _reference_images(camera_ids):
+    """
+    The most recent frame of each camera that went through inference (and
+    wasn't itself gated), with its detections, if it is recent enough.
+    """
+    since = datetime.now(timezone.utc) - timedelta(seconds=SIMILARITY_MAX_AGE_SECONDS)
+    references = get_db().image.find_many(
+        where={
+            "cameraId": {"in": camera_ids},
+            "detectionsProcessed": True,
+            "inferenceSkipped": False,
+            "signature": {"not": None},
+            "createdAt": {"gte": since},
+        },
+        order={"createdAt": "desc"},
+        distinct=["cameraId"],
+        include={"detections": True},
+    )
+    return {image.cameraId: image for image in references}
+
+
+def _claim_images(image_ids):
+    """
+    Take a lease on every image that isn't processed and isn't leased by a
+    live invocation.  Returns the lease id and the set of image ids claimed.
+    """
+    lease_id = uuid.uuid4().hex
+    now = datetime.now(timezone.utc)
+    get_db().image.update_many(
+        where={
+            "id": {"in": image_ids},
+            "detectionsProcessed": False,
+            "OR": [
+                {"detectionLeaseUntil": None},
+                {"detectionLeaseUntil": {"lt": now}},
+            ],
+        },
+        data={
+            "detectionLeaseId": lease_id,
+            "detectionLeaseUntil": now + timedelta(seconds=DETECTION_LEASE_SECONDS),
+        },
+    )
+    claimed = get_db().image.find_many(
+        where={"id": {"in": image_ids}, "detectionLeaseId": lease_id}
+    )
+    return lease_id, {image.id for image in claimed}
+
+
+def _release_images(lease_id, image_ids):
+    """Give up our lease on images we couldn't finish, so a retry can run."""
+    get_db().image.update_many(
+        where={"id": {"in": image_ids}, "detectionLeaseId": lease_id},
+        data={"detectionLeaseId": None, "detectionLeaseUntil": None},
+    )
+
+
+def _detection_id(image, *content):
+    """
+    A detection id derived from its image and content, so processing the same
+    frame twice produces the same rows and crop keys.
+    """
+    name = ":".join(str(part) for part in (image.hash, *content))
+    return uuid.uuid5(DETECTION_ID_NAMESPACE, name).hex
+
+
+def _crop_key(image, detection_id, detection):
+    """The S3 key a detection's crop is stored under."""
+    date_str = image.createdAt.strftime("%Y%m%d-%H%M%S")
+    confidence_str = f"{int(detection['confidence'] * 100):02d}"
+    label = detection["label"].replace(" ", "-")
+    return f"detections/{image.camera.coaId}/{date_str}-{image.id}/{confidence_str}-{label}-{detection_id}.jpg"
+
 
-    image_width = response_json.get("width")
-    image_height = response_json.get("height")
+def _atlas_key(image):
+    """The S3 key the crop atlas of an image is stored under."""
+    date_str = image.createdAt.strftime("%Y%m%d-%H%M%S")
+    return f"detections/{image.camera.coaId}/{date_str}-{image.id}.atlas"
 
-    # 1. Create all detections in DB
-    if detections:
-        new_detections_data = []
+
+def _crop_detections(item, image_bytes, rows, metrics):
+    """
+    Crop every detection row out of the in-memory source image, encoding the
+    crops on a bounded thread pool, and store them in S3: packed into one
+    atlas object, or each in its own object uploaded from the same pool.
+    Fills in each row's `picture` (and byte range, for an atlas) when its
+    upload succeeds.  Returns the size of the source image, if it could be
+    decoded.
+    """
+    from PIL import Image as PILImage
+
+    bucket = item["bucket"]
+
+    s3_client = _get_s3_client()
+    try:
+        # Decode once up front; lazily-loaded PIL images aren't thread-safe
+        source_image = PILImage.open(io.BytesIO(image_bytes)).convert("RGB")
+    except Exception as e:
+        print(f"Error decoding image {item['key']}: {e}")
+        return None, None
+
+    img_width, img_height = source_image.size
+    print(f"Source image size: {img_width}x{img_height}")
+
+    border = int(os.environ.get("DETECTION_IMAGE_BORDER", 10))
+    jpeg_quality = int(os.environ.get("DETECTION_IMAGE_QUALITY", 85))
+
+    def encode(row):
+        left = max(0, row["xMin"] - border)
+        top = max(0, row["yMin"] - border)
+        right = min(img_width, row["xMax"] + border)
+        bottom = min(img_height, row["yMax"] + border)
+
+        start = time.perf_counter()
+        cropped_image = source_image.crop((left, top, right, bottom))
+
+        img_byte_arr = io.BytesIO()
+        cropped_image.save(img_byte_arr, format="JPEG", quality=jpeg_quality)
+        # Summed over the threads, so these can exceed the wall time
+        metrics.add("crop_encode_ms", (time.perf_counter() - start) * 1000)
+        return img_byte_arr.getvalue()
+
+    def put(s3_key, body, content_type):
+        start = time.perf_counter()
+        try:
+            s3_client.put_object(
+                Bucket=bucket, Key=s3_key, Body=body, ContentType=content_type
+            )
+        except Exception as e:
+            print(f"Error uploading s3://{bucket}/{s3_key}: {e}")
+            metrics.add("upload_errors")
+            return False
+        finally:
+            metrics.add("crop_upload_ms", (time.perf_counter() - start) * 1000)
+        metrics.add("objects_uploaded")
+        metrics.add("bytes_uploaded", len(body))
+        print(f"Uploaded to s3://{bucket}/{s3_key}")
+        return True
+
+    def upload(row):
+        if put(row["_crop_key"], encode(row), "image/jpeg"):
+            metrics.add("crops_uploaded")
+            row["picture"] = row["_crop_key"]
+
+    if CROP_STORAGE != "atlas":
+        with ThreadPoolExecutor(
+            max_workers=min(CROP_UPLOAD_WORKERS, len(rows))
+        ) as pool:
+            list(pool.map(upload, rows))
+        return img_width, img_height
+
+    # Packed in id order, so reprocessing the frame rebuilds the same atlas
+    # and ranges for the same rows
+    rows = sorted(rows, key=lambda row: row["id"])
+    with ThreadPoolExecutor(max_workers=min(CROP_UPLOAD_WORKERS, len(rows))) as pool:
+        crops = list(pool.map(encode, rows))
+
+    atlas_key = rows[0]["_crop_key"]
+    body, ranges = pack(crops)
+    if put(atlas_key, body, ATLAS_CONTENT_TYPE):
+        metrics.add("crops_uploaded", len(rows))
+        for row, (offset, length) in zip(rows, ranges):
+            row["picture"] = atlas_key
+            row["pictureOffset"] = offset
+            row["pictureLength"] = length
+
+    return img_width, img_height
+
+
+def _store_detections(found, images, results, image_bytes, signatures, metrics):
+    """
+    Build, georeference, crop and insert the detections of every found item,
+    from its inference result or its gated reference, and mark the images
+    processed, releasing their leases.  Returns the updates made to each
+    image, by id.
+    """
+    # Build every detection row up front, ids and crop keys included.
+    # Gated frames get copies of their reference's rows, crops and all.
+    detection_rows = {}
+    for item in found:
+        image = images[item["image_hash"]]
+        if "reference" in item:
+            detection_rows[image.id] = [
+                {
+                    "id": _detection_id(image, "copy", detection.id),
+                    "label": detection.label,
+                    "confidence": detection.confidence,
+                    "xMin": detection.xMin,
+                    "yMin": detection.yMin,
+                    "xMax": detection.xMax,
+                    "yMax": detection.yMax,
+                    "imageId": image.id,
+                    "picture": detection.picture,
+                    "pictureOffset": detection.pictureOffset,
+                    "pictureLength": detection.pictureLength,
+                }
+                for detection in item["reference"].detections
+            ]
+            continue
+
+        detections = results[item["key"]]["detections"]
+        print(f"Found {len(detections)} detections for image {image.id}.")
+        rows = []
         for detection in detections:
             box = detection["box"]
-            new_detections_data.append(
+            detection_id = _detection_id(
+                image,
+                detection["label"],
+                *(int(box[k]) for k in ("xMin", "yMin", "xMax", "yMax")),
+            )
+            rows.append(
                 {
+                    "id": detection_id,
                     "label": detection["label"],
                     "confidence": detection["confidence"],
                     "xMin": int(box["xMin"]),
@@ -92,89 +668,513 @@ def handler(event, context):
                     "xMax": int(box["xMax"]),
                     "yMax": int(box["yMax"]),
                     "imageId": image.id,
+                    "_crop_key": (
+                        _atlas_key(image)
+                        if CROP_STORAGE == "atlas"
+                        else _crop_key(image, detection_id, detection)
+                    ),
                 }
             )
+        detection_rows[image.id] = rows
 
-        if new_detections_data:
-            db.detection.create_many(data=new_detections_data, skip_duplicates=True)
-            print(f"Created {len(new_detections_data)} detections in database.")
+    metrics.lap("build_rows")
 
-    # 2. Query them back
-    created_detections = db.detection.find_many(where={"imageId": image.id})
-    print(f"Queried back {len(created_detections)} detections.")
-
-    # 3. Process detections: crop, hash, print
-    if created_detections:
-        s3_client = boto3.client("s3")
+    # Place every detection on the map, one vectorized batch per image
+    if any(detection_rows.values()):
         try:
-            s3_response = s3_client.get_object(Bucket=bucket, Key=key)
-            image_bytes = s3_response["Body"].read()
-            source_image = PILImage.open(io.BytesIO(image_bytes))
+            from georeference import camera_transforms, georeference
+
+            transforms = camera_transforms(
+                get_db(), {images[item["image_hash"]].cameraId for item in found}
+            )
+            for item in found:
+                image = images[item["image_hash"]]
+                rows = detection_rows[image.id]
+                if not rows:
+                    continue
+                boxes = [[r["xMin"], r["yMin"], r["xMax"], r["yMax"]] for r in rows]
+                for row, fields in zip(
+                    rows, georeference(transforms[image.cameraId], boxes)
+                ):
+                    row.update(fields)
+        except Exception as e:
+            print(f"Error georeferencing detections: {e}")
+    metrics.lap("georeference")
 
-            img_width, img_height = source_image.size
-            print(f"Source image size: {img_width}x{img_height}")
+    # Crop and upload concurrently, then insert every row, picture
+    # included, with one statement
+    image_updates = {}
+    for item in found:
+        image = images[item["image_hash"]]
+        reference = item.get("reference")
+        if reference:
+            image_width, image_height = reference.width, reference.height
+        else:
+            image_width = results[item["key"]].get("width")
+            image_height = results[item["key"]].get("height")
+            if detection_rows[image.id]:
+                width, height = _crop_detections(
+                    item, image_bytes[item["key"]], detection_rows[image.id], metrics
+                )
+                image_width = width or image_width
+                image_height = height or image_height
+        image_updates[image.id] = {
+            "detectionsProcessed": True,
+            "width": image_width,
+            "height": image_height,
+            "signature": signatures[item["key"]],
+            "inferenceSkipped": reference is not None,
+            "referenceImageId": reference.id if reference else None,
+            "detectionLeaseId": None,
+            "detectionLeaseUntil": None,
+        }
 
-            image_width = img_width
-            image_height = img_height
+    metrics.lap("crops")
 
-            border = int(os.environ.get("DETECTION_IMAGE_BORDER", 10))
-            jpeg_quality = int(os.environ.get("DETECTION_IMAGE_QUALITY", 85))
+    new_detections_data = [
+        {k: v for k, v in row.items() if k != "_crop_key"}
+        for rows in detection_rows.values()
+        for row in rows
+    ]
+    if new_detections_data:
+        get_db().detection.create_many(data=new_detections_data, skip_duplicates=True)
+        print(f"Created {len(new_detections_data)} detections in database.")
+    metrics.add("detections", len(new_detections_data))
+    metrics.lap("insert")
 
-            for detection in created_detections:
-                left = max(0, detection.xMin - border)
-                top = max(0, detection.yMin - border)
-                right = min(img_width, detection.xMax + border)
-                bottom = min(img_height, detection.yMax + border)
+    # Mark every processed image in one round trip
+    if image_updates:
+        with get_db().batch_() as batcher:
+            for image_id, data in image_updates.items():
+                batcher.image.update(where={"id": image_id}, data=data)
+        print(f"Marked {len(image_updates)} images as detectionsProcessed.")
+    metrics.lap("update")
 
-                cropped_image = source_image.crop((left, top, right, bottom))
+    return image_updates
 
-                img_byte_arr = io.BytesIO()
-                cropped_image.convert("RGB").save(
-                    img_byte_arr, format="JPEG", quality=jpeg_quality
-                )
-                img_byte_arr_value = img_byte_arr.getvalue()
 
-                # sha256_hash = hashlib.sha256(img_byte_arr_value).hexdigest()
+@_entry_point
+def handler(event, context):
+    """
+    Main Lambda handler function
+    Handles every record of an S3 notification, or of an SQS batch of S3
+    notifications, with a single inference request and bulk database writes.
+    Parameters:
+        event: Dict containing the Lambda function event data
+        context: Lambda runtime context
+    Returns:
+        Dict compatible with Lambda Function URL / API Gateway, plus
+        batchItemFailures for SQS partial batch responses
+    """
+    # print("Received event: " + json.dumps(event, indent=2)) # keep this comment
 
-                # print(f"Detection {detection.id}: new image SHA256 is {sha256_hash}")
+    metrics = _Metrics()
+    items = _parse_records(event)
+    print(f"Received {len(items)} records.")
+    metrics.add("records", len(items))
+    metrics.add("retries", sum(1 for item in items if item["receive_count"] > 1))
 
-                date_str = image.createdAt.strftime("%Y%m%d-%H%M%S")
-                confidence_str = f"{int(detection.confidence * 100):02d}"
-                label = detection.label.replace(" ", "-")
-                s3_key = f"detections/{image.camera.coaId}/{date_str}-{image.id}/{confidence_str}-{label}-{detection.id}.jpg"
-                s3_client.put_object(
-                    Bucket=bucket,
-                    Key=s3_key,
-                    Body=img_byte_arr_value,
-                    ContentType="image/jpeg",
-                )
-                print(
-                    f"Detection {detection.id}  -> Uploaded to s3://{bucket}/{s3_key}"
+    # Messages that should be redelivered by SQS
+    failed_messages = set()
+
+    pending = []
+    for item in items:
+        print(f"Received key: {item['key']} from bucket: {item['bucket']}")
+        match = re.search(r"([^/]+)\.jpg$", item["key"])
+        if not match:
+            # Retrying can't fix a malformed key, so drop it
+            print(f"Could not extract image hash from key: {item['key']}")
+            continue
+        item["image_hash"] = match.group(1)
+        print(f"Extracted image_hash: {item['image_hash']}")
+        pending.append(item)
+    metrics.lap("parse")
+
+    # 1. Look up every image in one query
+    images = {}
+    if pending:
+        images = {
+            image.hash: image
+            for image in get_db().image.find_many(
+                where={"hash": {"in": [item["image_hash"] for item in pending]}},
+                include={"camera": True},
+            )
+        }
+
+    metrics.lap("lookup")
+
+    found = []
+    duplicates = 0
+    for item in pending:
+        image = images.get(item["image_hash"])
+        if not image:
+            # The row may not be committed yet; let SQS try again later
+            print(f"Image with hash {item['image_hash']} not found in database.")
+            failed_messages.add(item["message_id"])
+        elif image.detectionsProcessed:
+            # A redelivered or duplicate notification
+            print(f"Image {image.id} already processed, skipping.")
+            duplicates += 1
+        else:
+            found.append(item)
+
+    # Claim the images, so a concurrent duplicate doesn't process them too
+    lease_id, claimed = None, set()
+    if found:
+        lease_id, claimed = _claim_images(
+            list({images[item["image_hash"]].id for item in found})
+        )
+    for item in found:
+        if images[item["image_hash"]].id not in claimed:
+            # Another invocation holds the lease.  Retry later through SQS in
+            # case it dies; by then the image will most likely be processed.
+            print(f"Image {images[item['image_hash']].id} is leased elsewhere.")
+            duplicates += 1
+            failed_messages.add(item["message_id"])
+    # Two records for the same object in one batch are processed once
+    found = list(
+        {
+            item["image_hash"]: item
+            for item in found
+            if images[item["image_hash"]].id in claimed
+        }.values()
+    )
+
+    metrics.add("duplicates", duplicates)
+    metrics.add("images", len(found))
+    metrics.lap("claim")
+
+    # Everything claimed but not finished is released, whatever goes wrong
+    image_updates = {}
+    submitted = set()
+    try:
+        # 2. Read each frame from S3 once; inference and cropping share the copy
+        image_bytes = _fetch_images(found)
+        for item in found:
+            if item["key"] not in image_bytes:
+                failed_messages.add(item["message_id"])
+        found = [item for item in found if item["key"] in image_bytes]
+        metrics.add("bytes_downloaded", sum(map(len, image_bytes.values())))
+        metrics.lap("s3_get")
+
+        # 3. Gate: frames nearly identical to their camera's last inferred frame
+        #    reuse its detections instead of going through inference
+        signatures = {
+            item["key"]: _frame_signature(image_bytes[item["key"]]) for item in found
+        }
+        references = {}
+        if found and SIMILARITY_THRESHOLD > 0:
+            references = _reference_images(
+                list({images[item["image_hash"]].cameraId for item in found})
+            )
+
+        to_infer = []
+        for item in found:
+            image = images[item["image_hash"]]
+            reference = references.get(image.cameraId)
+            if reference and reference.id != image.id:
+                distance = _signature_distance(
+                    signatures[item["key"]], reference.signature
                 )
+                if distance <= SIMILARITY_THRESHOLD:
+                    print(
+                        f"Image {image.id} is {distance:.2f} from {reference.id}, "
+                        "reusing its detections."
+                    )
+                    item["reference"] = reference
+                    continue
+            to_infer.append(item)
 
-                db.detection.update(
-                    where={"id": detection.id}, data={"picture": s3_key}
+        if found:
+            skipped = len(found) - len(to_infer)
+            print(
+                f"Similarity gate skipped {skipped} of {len(found)} frames "
+                f"({skipped / len(found):.0%})."
+            )
+
+        metrics.add("skipped", len(found) - len(to_infer))
+        metrics.lap("gate")
+
+        # 4. Run inference on the rest in one request, or submit it as a job
+        #    whose results are stored later by results_handler
+        results = {}
+        if to_infer and INFERENCE_BACKEND == "async":
+            try:
+                _submit_inference_job(to_infer, images, image_bytes)
+                submitted = {images[item["image_hash"]].id for item in to_infer}
+            except Exception as e:
+                print(f"Error submitting inference job: {e}")
+                failed_messages.update(item["message_id"] for item in to_infer)
+                metrics.add("inference_errors")
+            metrics.add("submitted", len(submitted))
+        elif to_infer:
+            try:
+                results = _run_inference(
+                    [item["key"] for item in to_infer], image_bytes
                 )
+            except Exception as e:
+                print(f"Error running inference: {e}")
+                failed_messages.update(item["message_id"] for item in to_infer)
+                metrics.add("inference_errors")
+        metrics.add("inferred", len(results))
+        metrics.lap("inference")
+
+        found = [
+            item for item in found if "reference" in item or item["key"] in results
+        ]
+
+        # 5-7. Store the detections and mark the images processed
+        image_updates = _store_detections(
+            found, images, results, image_bytes, signatures, metrics
+        )
+    finally:
+        # Frames out for inference stay leased until their results are stored
+        unfinished = claimed - set(image_updates) - submitted
+        if unfinished:
+            try:
+                _release_images(lease_id, list(unfinished))
+                print(f"Released {len(unfinished)} unfinished images.")
+            except Exception as e:
+                # Don't mask the error that got us here; the leases expire
+                print(f"Error releasing images: {e}")
+            metrics.lap("release")
+
+    metrics.add("failed", len(failed_messages))
+    metrics.emit()
+
+    response = {
+        "statusCode": 200,
+        "body": json.dumps(
+            {
+                "message": "Successfully processed event and called endpoint.",
+                "processed": len(image_updates),
+                "submitted": len(submitted),
+                "skipped": sum(1 for item in found if "reference" in item),
+                "duplicates": duplicates,
+                "failed": len(failed_messages),
+            }
+        ),
+    }
+    if any(item["message_id"] for item in items):
+        response["batchItemFailures"] = [
+            {"itemIdentifier": message_id}
+            for message_id in failed_messages
+            if message_id
+        ]
+    return response
 
+
+@_entry_point
+def results_handler(event, context):
+    """
+    Lambda handler for the results of asynchronous inference jobs
+    Invoked by the S3 notifications, direct or through SQS, for the result
+    objects inference workers write under INFERENCE_RESULTS_PREFIX, and
+    stores each result the way the synchronous handler would have.
+    Parameters:
+        event: Dict containing the Lambda function event data
+        context: Lambda runtime context
+    Returns:
+        Dict compatible with Lambda Function URL / API Gateway, plus
+        batchItemFailures for SQS partial batch responses
+    """
+    metrics = _Metrics()
+    notifications = _parse_records(event)
+    print(f"Received {len(notifications)} results.")
+    metrics.add("records", len(notifications))
+
+    failed_messages = set()
+
+    def read_result(notification):
+        try:
+            s3_response = _get_s3_client().get_object(
+                Bucket=notification["bucket"], Key=notification["key"]
+            )
+            return json.loads(s3_response["Body"].read())
         except Exception as e:
-            print(f"Error processing image from S3: {e}")
+            print(f"Error reading result {notification['key']}: {e}")
+            return None
 
-    db.image.update(
-        where={"id": image.id},
-        data={
-            "detectionsProcessed": True,
-            "width": image_width,
-            "height": image_height,
+    fetched = []
+    if notifications:
+        with ThreadPoolExecutor(
+            max_workers=min(CROP_UPLOAD_WORKERS, len(notifications))
+        ) as pool:
+            fetched = list(pool.map(read_result, notifications))
+
+    # Each result names the frame it belongs to; its key is the image's hash
+    # and the job's id, under the prefix
+    received = []
+    for notification, result in zip(notifications, fetched):
+        match = re.search(r"([^/]+)/([^/]+)\.json$", notification["key"])
+        if not match:
+            print(f"Could not extract image hash from key: {notification['key']}")
+            continue
+        if result is None:
+            failed_messages.add(notification["message_id"])
+            continue
+        received.append(
+            (
+                {
+                    **notification,
+                    "key": result["key"],
+                    "image_hash": match.group(1),
+                },
+                match.group(2),
+                result,
+            )
+        )
+    pending = {item["image_hash"] for item, _, _ in received}
+    metrics.lap("parse")
+
+    images = {}
+    if pending:
+        images = {
+            image.hash: image
+            for image in get_db().image.find_many(
+                where={"hash": {"in": list(pending)}},
+                include={"camera": True},
+            )
+        }
+    metrics.lap("lookup")
+
+    results = {}
+    found = {}
+    duplicates = 0
+    stale = 0
+    for item, job, result in received:
+        image = images.get(item["image_hash"])
+        if not image:
+            print(f"Image with hash {item['image_hash']} not found in database.")
+        elif image.detectionsProcessed:
+            # A redelivered notification, or a resubmitted job's second result
+            print(f"Image {image.id} already processed, skipping.")
+            duplicates += 1
+        elif job != image.inferenceJobId:
+            # A job that was swept or resubmitted since; the current one's
+            # result is the one to store
+            print(
+                f"Dropping result of job {job} for image {image.id}, now in "
+                f"job {image.inferenceJobId}."
+            )
+            stale += 1
+        else:
+            results[item["key"]] = result
+            found[item["image_hash"]] = item
+    found = list(found.values())
+    metrics.add("duplicates", duplicates)
+    metrics.add("stale", stale)
+    metrics.add("images", len(found))
+
+    # Cropping needs the frames themselves
+    image_bytes = _fetch_images(found)
+    for item in found:
+        if item["key"] not in image_bytes:
+            failed_messages.add(item["message_id"])
+    found = [item for item in found if item["key"] in image_bytes]
+    metrics.add("bytes_downloaded", sum(map(len, image_bytes.values())))
+    metrics.lap("s3_get")
+
+    signatures = {
+        item["key"]: _frame_signature(image_bytes[item["key"]]) for item in found
+    }
+    image_updates = _store_detections(
+        found, images, results, image_bytes, signatures, metrics
+    )
+
+    metrics.add("failed", len(failed_messages))
+    metrics.emit()
+
+    response = {
+        "statusCode": 200,
+        "body": json.dumps(
+            {
+                "message": "Successfully stored inference results.",
+                "processed": len(image_updates),
+                "duplicates": duplicates,
+                "stale": stale,
+                "failed": len(failed_messages),
+            }
+        ),
+    }
+    if any(item["message_id"] for item in notifications):
+        response["batchItemFailures"] = [
+            {"itemIdentifier": message_id}
+            for message_id in failed_messages
+            if message_id
+        ]
+    return response
+
+
+@_entry_point
+def sweep_handler(event, context):
+    """
+    Scheduled Lambda handler that resubmits asynchronous inference jobs whose
+    results were lost: images still unprocessed after their job's lease ran
+    out.  No image is submitted more than INFERENCE_JOB_MAX_ATTEMPTS times;
+    the rest are counted as abandoned.
+    """
+    metrics = _Metrics()
+    now = datetime.now(timezone.utc)
+    overdue = get_db().image.find_many(
+        where={
+            "detectionsProcessed": False,
+            "inferenceJobAt": {"not": None},
+            "inferenceJobAttempts": {"lt": INFERENCE_JOB_MAX_ATTEMPTS},
+            "OR": [
+                {"detectionLeaseUntil": None},
+                {"detectionLeaseUntil": {"lt": now}},
+            ],
         },
+        order={"inferenceJobAt": "asc"},
+        take=INFERENCE_SWEEP_LIMIT,
+        include={"camera": True},
+    )
+    abandoned = get_db().image.count(
+        where={
+            "detectionsProcessed": False,
+            "inferenceJobAttempts": {"gte": INFERENCE_JOB_MAX_ATTEMPTS},
+        }
     )
-    print("Marked image as detectionsProcessed.")
+    print(f"Found {len(overdue)} overdue inference jobs, {abandoned} abandoned.")
+    metrics.add("overdue", len(overdue))
+    metrics.add("abandoned", abandoned)
+    metrics.lap("lookup")
+
+    resubmitted = []
+    if overdue:
+        lease_id, claimed = _claim_images([image.id for image in overdue])
+        resubmitted = [image for image in overdue if image.id in claimed]
+    metrics.lap("claim")
+
+    if resubmitted:
+        items = [
+            {"key": image.inferenceJobKey, "image_hash": image.hash}
+            for image in resubmitted
+        ]
+        try:
+            _submit_inference_job(items, {image.hash: image for image in resubmitted})
+        except Exception as e:
+            print(f"Error resubmitting inference jobs: {e}")
+            _release_images(lease_id, [image.id for image in resubmitted])
+            metrics.add("inference_errors")
+            resubmitted = []
+    metrics.add("submitted", len(resubmitted))
+    metrics.lap("submit")
+    metrics.emit()
 
     return {
         "statusCode": 200,
         "body": json.dumps(
             {
-                "message": "Successfully processed event and called endpoint.",
-                "endpoint_response": response.text,
+                "message": "Swept overdue inference jobs.",
+                "submitted": len(resubmitted),
+                "abandoned": abandoned,
             }
         ),
     }
+
+
+startup_timings["module_import_ms"] = round(
+    (time.perf_counter() - _import_started) * 1000, 2
+)
@@ -0,0 +1,173 @@
+"""
+Georeferencing of detections.
+
+Each camera's user-placed Location control points pair a pixel (x, y) with a
+(latitude, longitude).  From four or more of them we fit a homography that
+maps the camera's image plane onto the ground, which is a good model as long
+as the ground is roughly flat.  A detection's ground-contact point, the
+bottom centre of its box, is projected through it.  Outside the convex hull
+of the control points the fit is an extrapolation, which isInsideConvexHull
+records.
+"""
+
+import numpy as np
+
+
+# A homography has eight degrees of freedom, so it needs four points
+MIN_CONTROL_POINTS = 4
+
+# Fitted transforms by camera id, each with the version of the camera's
+# control points it was fitted from.  Kept for the life of the execution
+# environment; a changed, added or removed point changes the version.
+_transform_cache = {}
+
+
+class CameraTransform:
+    """A camera's fitted homography (or None) and control point hull."""
+
+    def __init__(self, homography, hull):
+        self.homography = homography
+        self.hull = hull
+
+
+def _normalization(points):
+    """
+    The similarity transform that centres `points` on the origin with a mean
+    distance of sqrt(2), which keeps the DLT well conditioned.
+    """
+    centroid = points.mean(axis=0)
+    mean_distance = np.linalg.norm(points - centroid, axis=1).mean()
+    scale = np.sqrt(2) / max(mean_distance, 1e-12)
+    return np.array(
+        [
+            [scale, 0, -scale * centroid[0]],
+            [0, scale, -scale * centroid[1]],
+            [0, 0, 1],
+        ]
+    )
+
+
+def project(homography, points):
+    """Apply a homography to an (N, 2) array of points."""
+    homogeneous = np.hstack([points, np.ones((len(points), 1))]) @ homography.T
+    return homogeneous[:, :2] / homogeneous[:, 2:]
+
+
+def fit_homography(source, target):
+    """
+    Least-squares (normalized DLT) fit of the 3x3 homography that maps the
+    (N, 2) `source` points onto the `target` points, N >= 4.
+    """
+    source_norm = _normalization(source)
+    target_norm = _normalization(target)
+    x, y = project(source_norm, source).T
+    u, v = project(target_norm, target).T
+
+    zeros = np.zeros_like(x)
+    ones = np.ones_like(x)
+    a = np.concatenate(
+        [
+            np.stack([-x, -y, -ones, zeros, zeros, zeros, u * x, u * y, u], axis=1),
+            np.stack([zeros, zeros, zeros, -x, -y, -ones, v * x, v * y, v], axis=1),
+        ]
+    )
+    # The solution is the right singular vector of the smallest singular value
+    _, _, vt = np.linalg.svd(a)
+    homography = np.linalg.inv(target_norm) @ vt[-1].reshape(3, 3) @ source_norm
+    return homography / homography[2, 2]
+
+
+def convex_hull(points):
+    """Counter-clockwise convex hull of (N, 2) points (Andrew's monotone chain)."""
+    points = sorted(set(map(tuple, points)))
+    if len(points) < 3:
+        return np.array(points, dtype=float).reshape(-1, 2)
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    lower, upper = [], []
+    for p in points:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+    for p in reversed(points):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+    return np.array(lower[:-1] + upper[:-1], dtype=float)
+
+
+def inside_hull(hull, points):
+    """
+    Whether each of the (N, 2) points lies in (or on) the counter-clockwise
+    `hull`, tested against every edge at once.
+    """
+    edges = np.roll(hull, -1, axis=0) - hull
+    offsets = points[:, None, :] - hull[None, :, :]
+    cross = edges[None, :, 0] * offsets[..., 1] - edges[None, :, 1] * offsets[..., 0]
+    return (cross >= 0).all(axis=1)
+
+
+def camera_transforms(db, camera_ids):
+    """
+    The fitted transform for each camera id, refitting only cameras whose
+    control points changed since they were last fitted.  Cameras with too
+    few points get a transform without a homography.
+    """
+    locations = {camera_id: [] for camera_id in camera_ids}
+    for location in db.location.find_many(where={"cameraId": {"in": list(camera_ids)}}):
+        locations[location.cameraId].append(location)
+
+    transforms = {}
+    for camera_id, points in locations.items():
+        version = (
+            len(points),
+            max((point.updatedAt for point in points), default=None),
+        )
+        cached = _transform_cache.get(camera_id)
+        if cached and cached[0] == version:
+            transforms[camera_id] = cached[1]
+            continue
+
+        pixels = np.array([[point.x, point.y] for point in points], dtype=float)
+        coordinates = np.array(
+            [[point.longitude, point.latitude] for point in points], dtype=float
+        )
+        homography = None
+        if len(points) >= MIN_CONTROL_POINTS:
+            homography = fit_homography(pixels, coordinates)
+        hull = convex_hull(pixels) if len(points) >= 3 else None
+
+        transform = CameraTransform(homography, hull)
+        _transform_cache[camera_id] = (version, transform)
+        transforms[camera_id] = transform
+    return transforms
+
+
+def georeference(transform, boxes):
+    """
+    Latitude, longitude and isInsideConvexHull for detections given as an
+    (N, 4) array of (xMin, yMin, xMax, yMax) boxes, all in one batch.
+    Returns a list of dicts of those three fields; they are None where the
+    camera's control points can't support them.
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    # Vehicles and people touch the ground at the bottom centre of their box
+    ground = np.stack([(boxes[:, 0] + boxes[:, 2]) / 2, boxes[:, 3]], axis=1)
+
+    lon_lat = None
+    if transform.homography is not None:
+        lon_lat = project(transform.homography, ground)
+    inside = None
+    if transform.hull is not None and len(transform.hull) >= 3:
+        inside = inside_hull(transform.hull, ground)
+
+    return [
+        {
+            "latitude": float(lon_lat[i, 1]) if lon_lat is not None else None,
+            "longitude": float(lon_lat[i, 0]) if lon_lat is not None else None,
+            "isInsideConvexHull": bool(inside[i]) if inside is not None else None,
+        }
+        for i in range(len(boxes))
+    ]
@@ -26,7 +26,7 @@ login() {
 build_and_push_proxy() {
   echo "Building and pushing camera-image-proxy..."
   LAMBDA_NAME="camera-image-proxy"
-  docker buildx build --platform linux/amd64 --provenance=false -t "${LAMBDA_NAME}:latest" proxy
+  docker buildx build --platform linux/amd64 --provenance=false --build-context shared=shared -t "${LAMBDA_NAME}:latest" proxy
   docker tag "${LAMBDA_NAME}:latest" "${ECR_REGISTRY}/${LAMBDA_NAME}:latest"
   docker push "${ECR_REGISTRY}/${LAMBDA_NAME}:latest"
   NEW_VERSION=$(aws lambda update-function-code --function-name "${LAMBDA_NAME}" --image-uri "${ECR_REGISTRY}/${LAMBDA_NAME}:latest" --publish --query 'Version' --output text)
@@ -37,7 +37,7 @@ build_and_push_proxy() {
 build_and_push_detector() {
   echo "Building and pushing detector..."
   LAMBDA_NAME="camera-image-detector"
-  docker buildx build --platform linux/amd64 --provenance=false --build-arg BEAM_TOKEN -t "${LAMBDA_NAME}:latest" detector
+  docker buildx build --platform linux/amd64 --provenance=false --build-context shared=shared --build-arg BEAM_TOKEN -t "${LAMBDA_NAME}:latest" detector
   docker tag "${LAMBDA_NAME}:latest" "${ECR_REGISTRY}/${LAMBDA_NAME}:latest"
   docker push "${ECR_REGISTRY}/${LAMBDA_NAME}:latest"
   NEW_VERSION=$(aws lambda update-function-code --function-name "${LAMBDA_NAME}" --image-uri "${ECR_REGISTRY}/${LAMBDA_NAME}:latest" --publish --query 'Version' --output text)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the hash overlay: the original full-frame RGBA shadow path
+against overlay.render_overlay, from CIF to 4K.  Also checks that both paths
+decode to the same pixels at every resolution; the shadow is clipped by the
+frame edge at the smaller ones.
+
+    python bench_overlay.py --iterations 20
+"""
+
+import argparse
+import hashlib
+import io
+import statistics
+import time
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageFilter
+
+import overlay
+
+RESOLUTIONS = {
+    "CIF": (352, 240),
+    "VGA": (640, 480),
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "4K": (3840, 2160),
+}
+
+
+def legacy_render_overlay(original_image_bytes, hash_prefix):
+    """The overlay path as it was in proxy.handler before overlay.py."""
+    img = Image.open(io.BytesIO(original_image_bytes)).convert("RGBA")
+
+    base_height = 1080.0
+    scale_factor = img.height / base_height
+    font_size = max(1, int(32 * scale_factor))
+    margin = max(1, int(10 * scale_factor))
+
+    font = None
+    for path in overlay.FONT_PATHS:
+        try:
+            font = ImageFont.truetype(path, font_size)
+            break
+        except IOError:
+            continue
+    if not font:
+        try:
+            font = ImageFont.load_default(size=font_size)
+        except AttributeError:
+            font = ImageFont.load_default()
+
+    draw = ImageDraw.Draw(img)
+    text_bbox = draw.textbbox((0, 0), hash_prefix, font=font)
+    text_width = text_bbox[2] - text_bbox[0]
+    x = img.width - text_width - margin
+    y = margin
+
+    shadow_layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
+    shadow_draw = ImageDraw.Draw(shadow_layer)
+    shadow_draw.text((x, y), hash_prefix, font=font, fill="black")
+    shadow_layer = shadow_layer.filter(ImageFilter.GaussianBlur(radius=5))
+    img = Image.alpha_composite(img, shadow_layer)
+
+    final_draw = ImageDraw.Draw(img)
+    final_draw.text((x, y), hash_prefix, font=font, fill="white")
+
+    buffer = io.BytesIO()
+    img.convert("RGB").save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def synthetic_frame(width, height):
+    """A camera-like JPEG: a gradient with some noise so it compresses realistically."""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    img = Image.merge("RGB", (gradient, noise, Image.blend(gradient, noise, 0.5)))
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def max_pixel_difference(frames):
+    """The largest per-channel difference between the two paths' output."""
+    worst = 0
+    for frame_bytes, text in frames:
+        legacy = Image.open(io.BytesIO(legacy_render_overlay(frame_bytes, text)))
+        current = Image.open(io.BytesIO(overlay.render_overlay(frame_bytes, text)))
+        extrema = ImageChops.difference(legacy, current).getextrema()
+        worst = max(worst, *(high for _, high in extrema))
+    return worst
+
+
+def time_render(render, frames, iterations):
+    """Median and p95 milliseconds for rendering, cycling through the frames."""
+    timings = []
+    for i in range(iterations):
+        frame_bytes, text = frames[i % len(frames)]
+        start = time.perf_counter()
+        render(frame_bytes, text)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(0.95 * (len(timings) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    mismatched = []
+    print(f"{'resolution':<10} {'path':<8} {'median ms':>10} {'p95 ms':>10}")
+    for name, (width, height) in RESOLUTIONS.items():
+        frame_bytes = synthetic_frame(width, height)
+        # Distinct hash prefixes per iteration, as on real cache misses
+        frames = [
+            (frame_bytes, hashlib.sha256(f"{name}-{i}".encode()).hexdigest()[:8])
+            for i in range(args.iterations)
+        ]
+
+        # Warm both paths so one-off costs (font load) don't skew the first run
+        legacy_render_overlay(*frames[0])
+        overlay.render_overlay(*frames[0])
+
+        legacy = time_render(legacy_render_overlay, frames, args.iterations)
+        current = time_render(overlay.render_overlay, frames, args.iterations)
+
+        print(f"{name:<10} {'legacy':<8} {legacy[0]:>10.1f} {legacy[1]:>10.1f}")
+        print(f"{name:<10} {'overlay':<8} {current[0]:>10.1f} {current[1]:>10.1f}")
+        print(f"{name:<10} {'speedup':<8} {legacy[0] / current[0]:>9.1f}x")
+
+        difference = max_pixel_difference(frames[:5])
+        print(f"{name:<10} {'max diff':<8} {difference:>10}")
+        if difference:
+            mismatched.append(name)
+
+    if mismatched:
+        raise SystemExit(f"Output differs from the legacy path at {mismatched}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import io
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont, ImageFilter
+
+# Common paths for fonts in Lambda/Linux environments
+FONT_PATHS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationMono-Regular.ttf",
+]
+
+SHADOW_BLUR_RADIUS = 5
+# A Gaussian blur bleeds a few standard deviations past the glyphs, so the
+# shadow sprite is padded by that much on every side.
+SHADOW_PADDING = SHADOW_BLUR_RADIUS * 3
+
+# Fonts keyed by size.  Loading a TrueType font means probing the filesystem
+# and parsing the file, so do it once per size per execution environment.
+_font_cache = {}
+
+
+def get_font(font_size):
+    """Return a (cached) fixed-width font of the given size."""
+    font = _font_cache.get(font_size)
+    if font is not None:
+        return font
+
+    for path in FONT_PATHS:
+        try:
+            font = ImageFont.truetype(path, font_size)
+            break
+        except IOError:
+            continue
+
+    if not font:
+        print("Could not load a truetype font, falling back to default.")
+        try:
+            # Pillow >= 9.5.0 supports the size argument
+            font = ImageFont.load_default(size=font_size)
+        except AttributeError:
+            print(
+                "Warning: Pillow version may not support 'size' for load_default(). Using default size."
+            )
+            font = ImageFont.load_default()
+
+    _font_cache[font_size] = font
+    return font
+
+
+@lru_cache(maxsize=64)
+def _shadow_sprite(text, font_size, crop=(0, 0, 0, 0)):
+    """
+    Pre-render the blurred shadow for `text` as an "L" mask covering only the
+    text's bounding box plus the blur padding, less the (left, top, right,
+    bottom) pixels of `crop` that fall outside the frame.  Blurring the
+    cropped mask extends it at the frame edge the way blurring the whole
+    frame does.  Returns the mask and the offset of its top-left corner
+    relative to the text's draw origin.
+    """
+    font = get_font(font_size)
+    left, top, right, bottom = font.getbbox(text)
+    crop_left, crop_top, crop_right, crop_bottom = crop
+
+    mask = Image.new(
+        "L",
+        (
+            right - left + 2 * SHADOW_PADDING - crop_left - crop_right,
+            bottom - top + 2 * SHADOW_PADDING - crop_top - crop_bottom,
+        ),
+        0,
+    )
+    ImageDraw.Draw(mask).text(
+        (SHADOW_PADDING - left - crop_left, SHADOW_PADDING - top - crop_top),
+        text,
+        font=font,
+        fill=255,
+    )
+    mask = mask.filter(ImageFilter.GaussianBlur(radius=SHADOW_BLUR_RADIUS))
+
+    return mask, (left - SHADOW_PADDING + crop_left, top - SHADOW_PADDING + crop_top)
+
+
+def draw_overlay(img, text):
+    """
+    Draw `text` with a soft black shadow in the upper right corner of an RGB
+    image, in place.  Only the sprite-sized region under the text is touched.
+    """
+    # Define a baseline for scaling UI elements. 1080p is a common standard.
+    base_height = 1080.0
+    scale_factor = img.height / base_height
+
+    # Scale font size and margin based on the image's vertical resolution.
+    # Ensure a minimum size of 1 to avoid errors with tiny images.
+    font_size = max(1, int(32 * scale_factor))
+    margin = max(1, int(10 * scale_factor))
+
+    font = get_font(font_size)
+
+    # Position text in the upper right corner
+    left, top, right, bottom = font.getbbox(text)
+    text_width = right - left
+
+    x = img.width - text_width - margin
+    y = margin
+
+    # Blend black through the blurred mask, cropped to the frame before
+    # blurring so the shadow meets the frame edge as a full-frame blur would
+    crop = (
+        max(0, SHADOW_PADDING - x - left),
+        max(0, SHADOW_PADDING - y - top),
+        max(0, x + right + SHADOW_PADDING - img.width),
+        max(0, y + bottom + SHADOW_PADDING - img.height),
+    )
+    mask, (dx, dy) = _shadow_sprite(text, font_size, crop)
+    img.paste(
+        (0, 0, 0), (x + dx, y + dy, x + dx + mask.width, y + dy + mask.height), mask
+    )
+
+    # Draw the white text on top
+    ImageDraw.Draw(img).text((x, y), text, font=font, fill="white")
+    return img
+
+
+def render_overlay(original_image_bytes, text):
+    """Decode a JPEG, draw the `text` overlay and re-encode it as JPEG."""
+    img = Image.open(io.BytesIO(original_image_bytes))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    draw_overlay(img, text)
+
+    # Save the modified image to a buffer
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def render_derivative(image_bytes, text, size=None, image_format="JPEG"):
+    """
+    Re-encode a rendered frame no larger than `size` and/or in another format.
+    JPEG draft mode lets the decoder downscale by up to 8x as it decodes, so a
+    thumbnail never pays for a full-resolution decode.  A downscaled frame
+    gets the `text` overlay redrawn at its own scale so it stays legible.
+    """
+    img = Image.open(io.BytesIO(image_bytes))
+    full_size = img.size
+    if size:
+        img.draft("RGB", size)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    if size:
+        img.thumbnail(size)
+    if img.size != full_size:
+        draw_overlay(img, text)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format)
+    return buffer.getvalue()
@@ -1,15 +1,29 @@
+import time
+
+# Taken before anything else is imported, for STARTUP_PROFILE
+_import_started = time.perf_counter()
+
 import json
-import urllib.request
+import math
 import base64
 import os
 import ssl
+import socket
+import sys
+import threading
+import contextlib
+import functools
 import redis
 import jwt
 import hashlib
 import io
-import boto3
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
-from prisma import Prisma
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from startup import get_db, reset_db, startup_timings, timed_init
+
+# boto3, urllib3, Pillow (with overlay.py) and Prisma are imported on first
+# use: a cache hit needs none of them, so a fresh container shouldn't pay to
+# load them before serving one.
 
 
 CORS_HEADERS = {
@@ -18,13 +32,179 @@ CORS_HEADERS = {
     "Access-Control-Allow-Headers": "*",
 }
 
+# How long a rendered frame is served from Redis, and how long the previous
+# frame is kept around for viewers that arrive while a refresh is running.
+CACHE_TTL_SECONDS = 60 * 5
+STALE_TTL_SECONDS = 60 * 60
+
+# Served frames are content-addressed.  camera:{id} and camera:{id}:stale
+# only hold the sha256 of a frame, which is stored once under frame:{sha256}
+# (and its derivatives under frame:{sha256}:{size}:{format}) base64-encoded
+# and ready to return, however many cameras and refreshes point at it.
+# Every store pushes the frame's expiry out past that of any pointer to it;
+# a pointer whose frame has been evicted is just a cache miss.
+FRAME_TTL_SECONDS = STALE_TTL_SECONDS
+VARIANT_TTL_SECONDS = CACHE_TTL_SECONDS
+
+# Follows a camera's pointer to its frame in one round trip.  KEYS[1] is the
+# pointer, ARGV[1] the frame key suffix of the derivative wanted and ARGV[2]
+# "1" to return the body as well as the hash.  The frame key is built here
+# rather than passed in KEYS, as it isn't known until the pointer is read;
+# like the MULTI in _store_in_cache, this assumes a single Redis node (or
+# primary), not Redis Cluster.
+FRAME_LOOKUP_SCRIPT = """
+local sha256 = redis.call('GET', KEYS[1])
+if not sha256 then
+    return false
+end
+local result = {sha256, redis.call('TTL', KEYS[1])}
+if ARGV[2] == '1' then
+    local frame = redis.call(
+        'HMGET', 'frame:' .. sha256 .. ARGV[1], 'body', 'content_type')
+    result[3] = frame[1]
+    result[4] = frame[2]
+end
+return result
+"""
+
+# How long the per-camera record of the last downloaded frame (its hash,
+# status and the origin's ETag / Last-Modified) is kept.  The render itself
+# is the one under frame:{sha256}, which may be evicted much sooner.
+LAST_FRAME_TTL_SECONDS = 60 * 60 * 24
+
+# Batch requests: how many cameras one token may name, how many misses are
+# refreshed at once, and the tile size used when composing a mosaic.
+BATCH_MAX_CAMERAS = 64
+BATCH_MAX_WORKERS = int(os.environ.get("BATCH_MAX_WORKERS", 8))
+MOSAIC_TILE_SIZE = (480, 270)
+
+# Upstream client: the CCTV origin, its timeouts and retries, and the circuit
+# breaker that stops calling a camera's origin after repeated failures.
+CCTV_BASE_URL = os.environ.get("CCTV_BASE_URL", "https://cctv.austinmobility.io")
+UPSTREAM_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 2))
+UPSTREAM_READ_TIMEOUT_SECONDS = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 5))
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", 2))
+UPSTREAM_BACKOFF_FACTOR = 0.2
+# The longest a download can take: every attempt timing out, plus backoff
+UPSTREAM_DEADLINE_SECONDS = (UPSTREAM_RETRIES + 1) * (
+    UPSTREAM_CONNECT_TIMEOUT_SECONDS + UPSTREAM_READ_TIMEOUT_SECONDS
+) + sum(UPSTREAM_BACKOFF_FACTOR * 2**i for i in range(UPSTREAM_RETRIES))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 3))
+CIRCUIT_COOLDOWN_SECONDS = int(os.environ.get("CIRCUIT_COOLDOWN", 60))
+
+# Single-flight settings: the lock outlives the slowest upstream download
+# plus the persist and render that follow it, and waiters poll the cache key
+# for as long as the lock can be held before settling for the stale frame.
+# Waiters never refresh the camera themselves.
+SINGLE_FLIGHT_LOCK_TTL_SECONDS = int(
+    os.environ.get(
+        "SINGLE_FLIGHT_LOCK_TTL", max(30, math.ceil(UPSTREAM_DEADLINE_SECONDS) + 10)
+    )
+)
+SINGLE_FLIGHT_WAIT_SECONDS = float(
+    os.environ.get("SINGLE_FLIGHT_WAIT", SINGLE_FLIGHT_LOCK_TTL_SECONDS)
+)
+SINGLE_FLIGHT_POLL_SECONDS = 0.1
+
+# Derivatives: bounding boxes for the smaller sizes and the Pillow encoder
+# behind each output format.
+DERIVATIVE_SIZES = {"thumb": (320, 180), "medium": (960, 540), "full": None}
+IMAGE_FORMATS = {"jpeg": "JPEG", "webp": "WEBP"}
+
+# Cache warming: per-camera request counts live in a sorted set that decays
+# each time the scheduled warmer runs, which refreshes the hottest cameras
+# whose cached frame is about to expire.
+POPULARITY_KEY = "camera:popularity"
+POPULARITY_DECAY = float(os.environ.get("POPULARITY_DECAY", 0.95))
+WARM_TOP_K = int(os.environ.get("WARM_TOP_K", 50))
+WARM_AHEAD_SECONDS = int(os.environ.get("WARM_AHEAD_SECONDS", 90))
+
+# Write-behind settings: the stream the miss path queues bookkeeping on, and
+# how the scheduled consumer drains it.
+PERSIST_STREAM = os.environ.get("PERSIST_STREAM", "proxy:persist")
+PERSIST_GROUP = "persisters"
+PERSIST_STREAM_MAXLEN = 100000
+PERSIST_ORIGINAL_TTL_SECONDS = 60 * 60 * 2
+PERSIST_BATCH_SIZE = int(os.environ.get("PERSIST_BATCH_SIZE", 200))
+PERSIST_MAX_BATCHES = int(os.environ.get("PERSIST_MAX_BATCHES", 10))
+PERSIST_CLAIM_IDLE_MS = 60 * 1000
+PERSIST_UPLOAD_WORKERS = 8
+
+# STARTUP_PROFILE=true logs, after the first invocation of an execution
+# environment, how long importing this module took and how long each lazily
+# initialised dependency took to import and set up.  Set
+# PYTHONPROFILEIMPORTTIME=1 as well for a breakdown of every import.
+STARTUP_PROFILE = os.environ.get("STARTUP_PROFILE", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
 # Lazily-initialised module-level Redis client.  This allows the same
 # connection to be reused across multiple Lambda invocations that share the
 # execution environment, dramatically reducing cold-start time.
 _redis_client = None
+_redis_lock = threading.Lock()
+_fallback_image = None
+
+# Upstream and AWS clients are likewise created once per execution
+# environment, so keep-alive connections survive between invocations.  Batch
+# misses are refreshed from a thread pool, so each client is created under a
+# lock.
+_http_pool = None
+_http_pool_lock = threading.Lock()
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+# Whether the startup profile has been logged yet
+_startup_reported = False
+
+
+class UpstreamError(Exception):
+    """The CCTV origin failed, or is presumed failing, for a camera."""
+
+
+def _profile_startup(handler):
+    """
+    Log the startup profile once per execution environment, after the first
+    invocation of any entry point, when STARTUP_PROFILE is on.
+    """
 
-db = Prisma()
-db.connect()
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _startup_reported
+        start = time.perf_counter()
+        try:
+            return handler(event, context)
+        finally:
+            if STARTUP_PROFILE and not _startup_reported:
+                _startup_reported = True
+                profile = {
+                    "entry_point": handler.__name__,
+                    **startup_timings,
+                    "first_invocation_ms": round(
+                        (time.perf_counter() - start) * 1000, 2
+                    ),
+                    "loaded": [
+                        name
+                        for name in ("boto3", "urllib3", "PIL", "prisma")
+                        if name in sys.modules
+                    ],
+                }
+                print(json.dumps({"startup_profile": profile}))
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def _db_transaction():
+    """A transaction on the shared Prisma client, reconnecting after failures."""
+    try:
+        with get_db().tx() as transaction:
+            yield transaction
+    except Exception as e:
+        reset_db(e)
+        raise
 
 
 def _get_redis_client():
@@ -33,53 +213,118 @@ def _get_redis_client():
     if _redis_client is not None:
         return _redis_client
 
-    try:
-        redis_host = os.environ.get("REDIS_HOST", "localhost")
-        redis_port = int(os.environ.get("REDIS_PORT", 6379))
-        redis_password = os.environ.get("REDIS_PASSWORD")
-        # The docker-compose file starts Redis with TLS only, so default to TLS
-        use_tls = os.environ.get("REDIS_USE_TLS", "true").lower() in (
-            "1",
-            "true",
-            "yes",
-        )
-
-        connection_kwargs = {
-            "host": redis_host,
-            "port": redis_port,
-            "password": redis_password,
-            # We want raw bytes; the Lambda will do its own base64 encoding
-            "decode_responses": False,
-        }
+    with _redis_lock:
+        if _redis_client is not None:
+            return _redis_client
 
-        if use_tls:
-            connection_kwargs.update(
-                {
-                    "ssl": True,
-                    "ssl_cert_reqs": ssl.CERT_NONE,
-                }
+        try:
+            redis_host = os.environ.get("REDIS_HOST", "localhost")
+            redis_port = int(os.environ.get("REDIS_PORT", 6379))
+            redis_password = os.environ.get("REDIS_PASSWORD")
+            # The docker-compose file starts Redis with TLS only, so default to TLS
+            use_tls = os.environ.get("REDIS_USE_TLS", "true").lower() in (
+                "1",
+                "true",
+                "yes",
             )
 
-        _redis_client = redis.Redis(**connection_kwargs)
-        # Validate the connection – raises if authentication fails
-        _redis_client.ping()
-        print("Connected to Redis at", redis_host)
-    except Exception as err:
-        # Log the problem and fall back to no-cache mode
-        print(f"Redis connection failed: {err}")
-        _redis_client = None
+            connection_kwargs = {
+                "host": redis_host,
+                "port": redis_port,
+                "password": redis_password,
+                # We want raw bytes; the Lambda will do its own base64 encoding
+                "decode_responses": False,
+            }
+
+            if use_tls:
+                connection_kwargs.update(
+                    {
+                        "ssl": True,
+                        "ssl_cert_reqs": ssl.CERT_NONE,
+                    }
+                )
+
+            _redis_client = redis.Redis(**connection_kwargs)
+            # Validate the connection – raises if authentication fails
+            _redis_client.ping()
+            print("Connected to Redis at", redis_host)
+        except Exception as err:
+            # Log the problem and fall back to no-cache mode
+            print(f"Redis connection failed: {err}")
+            _redis_client = None
 
     return _redis_client
 
 
+def _overlay():
+    """overlay.py, and with it Pillow, imported on first use."""
+    with timed_init("overlay"):
+        import overlay
+    return overlay
+
+
+def _get_http_pool():
+    """
+    Return the pooled HTTP client for the CCTV origin.  Requests time out
+    quickly and are retried a bounded number of times on connection errors
+    and gateway failures.
+    """
+    global _http_pool
+    if _http_pool is None:
+        with _http_pool_lock:
+            if _http_pool is None:
+                with timed_init("urllib3"):
+                    import urllib3
+
+                _http_pool = urllib3.PoolManager(
+                    maxsize=BATCH_MAX_WORKERS,
+                    timeout=urllib3.Timeout(
+                        connect=UPSTREAM_CONNECT_TIMEOUT_SECONDS,
+                        read=UPSTREAM_READ_TIMEOUT_SECONDS,
+                    ),
+                    retries=urllib3.Retry(
+                        total=UPSTREAM_RETRIES,
+                        backoff_factor=UPSTREAM_BACKOFF_FACTOR,
+                        status_forcelist=(502, 503, 504),
+                        allowed_methods=frozenset({"GET"}),
+                        raise_on_status=False,
+                    ),
+                )
+    return _http_pool
+
+
+def _get_s3_client():
+    """Return the shared S3 client."""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                with timed_init("boto3"):
+                    import boto3
+
+                    _s3_client = boto3.client(
+                        "s3",
+                        region_name=os.environ.get("AWS_REGION", "us-east-1"),
+                    )
+    return _s3_client
+
+
+def _load_fallback_image():
+    """Return the bytes of the fallback image, read once per environment."""
+    global _fallback_image
+    if _fallback_image is None:
+        script_dir = os.path.dirname(__file__)
+        fallback_path = os.path.join(script_dir, "nonono.jpg")
+        with open(fallback_path, "rb") as f:
+            _fallback_image = f.read()
+    return _fallback_image
+
+
 def _serve_fallback_image(reason, status_code=200):
     """Log the reason and return a response to serve the fallback image."""
     print(f"{reason}. Serving fallback image.")
     try:
-        script_dir = os.path.dirname(__file__)
-        fallback_path = os.path.join(script_dir, "nonono.jpg")
-        with open(fallback_path, "rb") as f:
-            image_bytes = f.read()
+        image_bytes = _load_fallback_image()
 
         encoded_image = base64.b64encode(image_bytes).decode("utf-8")
 
@@ -98,6 +343,749 @@ def _serve_fallback_image(reason, status_code=200):
         }
 
 
+def _etag_matches(if_none_match, tag):
+    """Whether an If-None-Match header covers the representation with this tag."""
+    if not if_none_match or not tag:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == f'"{tag}"':
+            return True
+    return False
+
+
+def _frame_cache_headers(tag, max_age):
+    """
+    Validator and freshness headers for a served frame.  The token can arrive
+    in the x-camera header, so shared caches must key on it as well as the URL.
+    """
+    return {
+        "ETag": f'"{tag}"',
+        "Cache-Control": f"public, max-age={max_age}",
+        "Vary": "x-camera",
+    }
+
+
+def _not_modified_response(tag, max_age):
+    """A 304 telling the client its copy of the frame is still current."""
+    return {
+        "statusCode": 304,
+        "headers": {**_frame_cache_headers(tag, max_age), **CORS_HEADERS},
+        "body": "",
+    }
+
+
+def _variant_suffix(size, image_format):
+    """The frame key suffix of a derivative, empty for the full-size JPEG."""
+    if size == "full" and image_format == "jpeg":
+        return ""
+    return f":{size}:{image_format}"
+
+
+def _frame_key(sha256_hash, suffix=""):
+    """The Redis key of a rendered frame, or of one of its derivatives."""
+    return f"frame:{sha256_hash}{suffix}"
+
+
+def _variant_etag(sha256_hash, size, image_format):
+    """Each derivative of a frame is its own representation with its own tag."""
+    if size == "full" and image_format == "jpeg":
+        return sha256_hash
+    return f"{sha256_hash}-{size}.{image_format}"
+
+
+def _queue_frame(pipe, frame_key, sha256_hash, content_type, encoded_body, ttl):
+    """
+    Queue the storing of a rendered frame, already base64-encoded.  The
+    capture time is that of the first store, however often the same frame
+    comes round again.
+    """
+    pipe.hset(
+        frame_key,
+        mapping={
+            "sha256": sha256_hash,
+            "content_type": content_type,
+            "body": encoded_body,
+        },
+    )
+    pipe.hsetnx(frame_key, "captured_at", datetime.now(timezone.utc).isoformat())
+    pipe.expire(frame_key, ttl)
+
+
+def _lookup_frame(redis_client, cache_key, suffix="", with_body=True):
+    """
+    Look up, or queue on a pipeline the lookup of, the frame a camera key
+    points at.  The reply is None when there is no pointer, otherwise
+    [sha256, seconds the pointer has left] followed, with_body, by the
+    frame's base64 body and content type, both None if it is gone.
+    """
+    # EVAL rather than a registered script: a pipeline holding one checks
+    # that the script is loaded with a round trip of its own
+    return redis_client.eval(
+        FRAME_LOOKUP_SCRIPT, 1, cache_key, suffix, "1" if with_body else "0"
+    )
+
+
+def _get_frame(redis_client, sha256_hash, suffix=""):
+    """Return [base64 body, content type] of a stored frame; None if absent."""
+    return redis_client.hmget(_frame_key(sha256_hash, suffix), "body", "content_type")
+
+
+def _store_variant(redis_client, sha256_hash, suffix, content_type, body_bytes):
+    """
+    Cache a derivative of a frame under the frame's hash.  Returns the body
+    base64-encoded, as it is served.
+    """
+    encoded_body = base64.b64encode(body_bytes).decode("utf-8")
+    try:
+        pipe = redis_client.pipeline()
+        _queue_frame(
+            pipe,
+            _frame_key(sha256_hash, suffix),
+            sha256_hash,
+            content_type,
+            encoded_body,
+            VARIANT_TTL_SECONDS,
+        )
+        pipe.execute()
+    except Exception as r_err:
+        print(f"Failed to store derivative in Redis: {r_err}")
+    return encoded_body
+
+
+def _single_flight_enabled():
+    """Whether concurrent cache misses for a camera should be coalesced."""
+    return os.environ.get("SINGLE_FLIGHT", "true").lower() in ("1", "true", "yes")
+
+
+def _store_in_cache(redis_client, cache_key, sha256_hash, image_bytes):
+    """
+    Store a freshly rendered frame under its hash, and point the camera's
+    key and its longer-lived stale key at it.
+    """
+    try:
+        pipe = redis_client.pipeline()
+        _queue_frame(
+            pipe,
+            _frame_key(sha256_hash),
+            sha256_hash,
+            "image/jpeg",
+            base64.b64encode(image_bytes),
+            FRAME_TTL_SECONDS,
+        )
+        pipe.set(cache_key, sha256_hash, ex=CACHE_TTL_SECONDS)
+        pipe.set(f"{cache_key}:stale", sha256_hash, ex=STALE_TTL_SECONDS)
+        pipe.execute()
+        print(f"Stored image in Redis with TTL={CACHE_TTL_SECONDS}s")
+    except Exception as r_err:
+        print(f"Failed to store image in Redis: {r_err}")
+
+
+def _get_cached_frame(redis_client, key):
+    """Return (sha256, bytes) for a cached frame, or (None, None) if absent."""
+    cached = _lookup_frame(redis_client, key)
+    if not cached or not cached[2]:
+        return None, None
+    return cached[0].decode(), base64.b64decode(cached[2])
+
+
+def _refresh_single_flight(redis_client, camera_id, cache_key):
+    """
+    Refresh a camera so that only one invocation at a time does the work.
+
+    The invocation that wins a short-lived Redis lock downloads, persists and
+    renders the frame.  Everyone else polls the cache key until the frame
+    shows up or the lock is released or expires, then falls back to the
+    previous frame.  Returns (sha256, JPEG bytes); the bytes are None if the
+    camera is unavailable or no frame turned up.
+    """
+    lock = redis_client.lock(
+        f"lock:{cache_key}", timeout=SINGLE_FLIGHT_LOCK_TTL_SECONDS, blocking=False
+    )
+    try:
+        acquired = lock.acquire()
+    except Exception as r_err:
+        print(f"Failed to acquire single-flight lock: {r_err}")
+        acquired = False
+        lock = None
+
+    if acquired:
+        try:
+            return _refresh_and_cache(redis_client, camera_id, cache_key)
+        finally:
+            try:
+                lock.release()
+            except Exception as r_err:
+                # The lock may have expired while we were refreshing
+                print(f"Failed to release single-flight lock: {r_err}")
+
+    if lock is None:
+        # Redis can't coordinate the refresh, so do it here
+        print("No single-flight lock, refreshing directly.")
+        return _refresh_and_cache(redis_client, camera_id, cache_key)
+
+    print(f"Refresh of camera {camera_id} in flight elsewhere, waiting.")
+    deadline = time.monotonic() + SINGLE_FLIGHT_WAIT_SECONDS
+    try:
+        while True:
+            time.sleep(SINGLE_FLIGHT_POLL_SECONDS)
+            # Checked before the cache, so a frame stored just before the
+            # lock was released is still found
+            released = not lock.locked()
+            sha256_hash, image_bytes = _get_cached_frame(redis_client, cache_key)
+            if image_bytes:
+                print("Single-flight refresh finished – serving from Redis")
+                return sha256_hash, image_bytes
+            if released or time.monotonic() >= deadline:
+                break
+
+        sha256_hash, image_bytes = _get_cached_frame(redis_client, f"{cache_key}:stale")
+        if image_bytes:
+            print("No frame from single-flight refresh – serving stale frame")
+            return sha256_hash, image_bytes
+    except Exception as r_err:
+        print(f"Failed while waiting on single-flight refresh: {r_err}")
+
+    print(f"No frame from single-flight refresh of camera {camera_id}.")
+    return None, None
+
+
+def _refresh_and_cache(redis_client, camera_id, cache_key):
+    """Refresh a camera and cache the rendered frame if it is available."""
+    sha256_hash, image_bytes = _refresh_camera(camera_id, redis_client)
+    if image_bytes is not None:
+        _store_in_cache(redis_client, cache_key, sha256_hash, image_bytes)
+    return sha256_hash, image_bytes
+
+
+def _refresh_frame(redis_client, camera_id, skip_cache):
+    """
+    Refresh a camera after a cache miss, coalescing concurrent misses when
+    possible, and cache the result.  Cameras whose origin keeps failing get
+    their stale frame, if any, without another attempt.  Returns (sha256,
+    JPEG bytes); the bytes are None if the camera is unavailable.
+    """
+    cache_key = f"camera:{camera_id}"
+    try:
+        if _circuit_open(redis_client, camera_id):
+            raise UpstreamError(f"Circuit open for camera {camera_id}")
+
+        if redis_client and not skip_cache and _single_flight_enabled():
+            return _refresh_single_flight(redis_client, camera_id, cache_key)
+
+        sha256_hash, image_bytes = _refresh_camera(camera_id, redis_client)
+        if image_bytes is not None and redis_client and not skip_cache:
+            _store_in_cache(redis_client, cache_key, sha256_hash, image_bytes)
+        return sha256_hash, image_bytes
+    except UpstreamError as e:
+        print(f"{e}. Serving stale frame if there is one.")
+        if redis_client:
+            try:
+                return _get_cached_frame(redis_client, f"{cache_key}:stale")
+            except Exception as r_err:
+                print(f"Failed to fetch stale frame from Redis: {r_err}")
+        return None, None
+
+
+def _circuit_open(redis_client, camera_id):
+    """Whether the camera's origin has failed often enough to stop trying."""
+    if not redis_client:
+        return False
+    try:
+        return bool(redis_client.exists(f"circuit:{camera_id}:open"))
+    except Exception as r_err:
+        print(f"Failed to check circuit breaker in Redis: {r_err}")
+        return False
+
+
+def _record_upstream_result(redis_client, camera_id, ok):
+    """
+    Track consecutive origin failures for a camera and open its circuit once
+    they reach the threshold.  The failure count outlives the cooldown, so a
+    camera still failing afterwards re-opens on its first failed attempt.
+    """
+    if not redis_client:
+        return
+    failures_key = f"circuit:{camera_id}:failures"
+    try:
+        if ok:
+            redis_client.delete(failures_key)
+            return
+        pipe = redis_client.pipeline()
+        pipe.incr(failures_key)
+        pipe.expire(failures_key, CIRCUIT_COOLDOWN_SECONDS * 3)
+        failures = pipe.execute()[0]
+        if failures >= CIRCUIT_FAILURE_THRESHOLD:
+            print(f"Opening circuit for camera {camera_id} after {failures} failures")
+            redis_client.setex(
+                f"circuit:{camera_id}:open", CIRCUIT_COOLDOWN_SECONDS, failures
+            )
+    except Exception as r_err:
+        print(f"Failed to update circuit breaker in Redis: {r_err}")
+
+
+def _write_behind_enabled():
+    """Whether miss-path bookkeeping should be queued instead of done inline."""
+    return os.environ.get("WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+
+
+def _download_frame(camera_id, validators=None):
+    """
+    Download a camera's current frame, conditionally if we hold validators
+    (ETag / Last-Modified) from the previous download.
+    Returns (response_code, bytes, validators); bytes is None on a 304.
+    Raises UpstreamError if the origin can't be reached or answers an error.
+    """
+    # The pool first, so that STARTUP_PROFILE times urllib3's import there
+    http_pool = _get_http_pool()
+    import urllib3
+
+    image_url = f"{CCTV_BASE_URL}/image/{camera_id}.jpg"
+    request_headers = {}
+    if validators:
+        if validators.get("etag"):
+            request_headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            request_headers["If-Modified-Since"] = validators["last_modified"]
+
+    try:
+        img_response = http_pool.request("GET", image_url, headers=request_headers)
+    except urllib3.exceptions.HTTPError as e:
+        raise UpstreamError(f"Failed to download camera {camera_id}: {e}") from e
+
+    if img_response.status == 304:
+        return 304, None, _response_validators(img_response.headers) or validators
+    if img_response.status >= 400:
+        raise UpstreamError(
+            f"Camera {camera_id} origin answered HTTP {img_response.status}"
+        )
+    return (
+        img_response.status,
+        img_response.data,
+        _response_validators(img_response.headers),
+    )
+
+
+def _response_validators(headers):
+    """Pick the cache validators the origin sent, if any."""
+    validators = {}
+    if headers.get("ETag"):
+        validators["etag"] = headers["ETag"]
+    if headers.get("Last-Modified"):
+        validators["last_modified"] = headers["Last-Modified"]
+    return validators
+
+
+def _get_last_frame(redis_client, camera_id):
+    """
+    Return the record of the camera's last downloaded frame: its sha256,
+    status and the origin's validators.  Empty if unknown.
+    """
+    if not redis_client:
+        return {}
+    try:
+        record = redis_client.hgetall(f"camera:{camera_id}:last")
+    except Exception as r_err:
+        print(f"Failed to fetch last frame record from Redis: {r_err}")
+        return {}
+    return {k.decode(): v for k, v in record.items()}
+
+
+def _store_last_frame(redis_client, camera_id, sha256_hash, status, validators):
+    """Remember the frame just processed so an unchanged re-download is cheap."""
+    if not redis_client:
+        return
+    last_key = f"camera:{camera_id}:last"
+    try:
+        pipe = redis_client.pipeline()
+        pipe.delete(last_key)
+        pipe.hset(
+            last_key,
+            mapping={
+                "sha256": sha256_hash,
+                "status": status,
+                **validators,
+            },
+        )
+        pipe.expire(last_key, LAST_FRAME_TTL_SECONDS)
+        pipe.execute()
+    except Exception as r_err:
+        print(f"Failed to store last frame record in Redis: {r_err}")
+
+
+def _last_rendered(redis_client, last_frame):
+    """
+    Return (found, JPEG bytes) for the frame a last-frame record names, from
+    the frame cache.  The bytes are None if the camera was unavailable, and
+    found is False if the render has been evicted since.
+    """
+    if last_frame["status"] == b"unavailable":
+        return True, None
+    try:
+        encoded_body, _ = _get_frame(redis_client, last_frame["sha256"].decode())
+    except Exception as r_err:
+        print(f"Failed to fetch last render from Redis: {r_err}")
+        encoded_body = None
+    if not encoded_body:
+        return False, None
+    return True, base64.b64decode(encoded_body)
+
+
+def _frame_status(response_code, sha256_hash):
+    """Derive the camera status name from the response code and image hash."""
+    unavailable_image_hash = os.environ.get("UNAVAILABLE_IMAGE_HASH")
+    if response_code == 200 and sha256_hash == unavailable_image_hash:
+        return "unavailable"
+    return str(response_code)
+
+
+def _s3_bucket():
+    return os.environ.get("S3_BUCKET_NAME", "atx-traffic-cameras")
+
+
+def _s3_key(camera_id, sha256_hash):
+    return f"cameras/{camera_id}/{sha256_hash}.jpg"
+
+
+def _archive_to_s3(camera_id, sha256_hash, original_image_bytes):
+    """Upload the original frame to S3 unless it is already there.
+
+    Returns True if the object exists in S3 afterwards.
+    """
+    s3 = _get_s3_client()
+    s3_bucket = _s3_bucket()
+    s3_key = _s3_key(camera_id, sha256_hash)
+    try:
+        try:
+            s3.head_object(Bucket=s3_bucket, Key=s3_key)
+            print(
+                f"File already exists in S3: s3://{s3_bucket}/{s3_key}, skipping upload."
+            )
+            return True
+        except s3.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] == "404":
+                print(f"Uploading image to S3: s3://{s3_bucket}/{s3_key}")
+                s3.upload_fileobj(
+                    io.BytesIO(original_image_bytes),
+                    s3_bucket,
+                    s3_key,
+                    ExtraArgs={"ContentType": "image/jpeg"},
+                )
+                print("Successfully uploaded to S3.")
+                return True
+            else:
+                # Log other client errors
+                print(f"Error checking S3 for {s3_key}: {e}")
+    except Exception as s3_err:
+        print(f"An error occurred during S3 operation: {s3_err}")
+    return False
+
+
+def _persist_frame(camera_id, sha256_hash, status, original_image_bytes):
+    """
+    Record the camera's status and the frame in one transaction, then
+    archive the frame.  The rows are committed before the upload, which is
+    what triggers the detector.
+    """
+    with _db_transaction() as transaction:
+        status_record = transaction.status.upsert(
+            where={"name": status},
+            data={"create": {"name": status}, "update": {}},
+        )
+        camera_record = transaction.camera.upsert(
+            where={"coaId": int(camera_id)},
+            data={
+                "create": {
+                    "coaId": int(camera_id),
+                    "statusId": status_record.id,
+                },
+                "update": {"statusId": status_record.id},
+            },
+        )
+
+        transaction.camerastatus.create(
+            data={
+                "cameraId": camera_record.id,
+                "statusId": status_record.id,
+            }
+        )
+
+        if status == "unavailable":
+            return
+
+        image_record = transaction.image.create(
+            data={
+                "hash": sha256_hash,
+                "cameraId": camera_record.id,
+                "statusId": status_record.id,
+                "s3Uploaded": False,
+                "detectionsProcessed": False,
+            }
+        )
+
+    if _archive_to_s3(camera_id, sha256_hash, original_image_bytes):
+        # Update image record to reflect it exists in S3
+        with _db_transaction() as transaction:
+            transaction.image.update(
+                where={"id": image_record.id}, data={"s3Uploaded": True}
+            )
+
+
+def _enqueue_persistence(
+    redis_client, camera_id, sha256_hash, status, original_image_bytes
+):
+    """
+    Queue the miss-path bookkeeping for the persistence consumer.
+
+    The original bytes are parked under their own key so the stream entries
+    stay small; the consumer deletes them once the frame is archived.
+    """
+    record = {
+        "camera_id": camera_id,
+        "sha256": sha256_hash,
+        "status": status,
+        "captured_at": datetime.now(timezone.utc).isoformat(),
+    }
+    pipe = redis_client.pipeline()
+    if status != "unavailable":
+        original_key = f"original:{sha256_hash}"
+        pipe.setex(original_key, PERSIST_ORIGINAL_TTL_SECONDS, original_image_bytes)
+        record["original_key"] = original_key
+    pipe.xadd(PERSIST_STREAM, record, maxlen=PERSIST_STREAM_MAXLEN, approximate=True)
+    pipe.execute()
+    print(f"Queued persistence of camera {camera_id} frame {sha256_hash[:8]}")
+
+
+def _refresh_camera(camera_id, redis_client=None):
+    """
+    Download a fresh frame from the Austin Mobility CCTV feed, record the
+    camera's status, archive the original to S3 and render the hash overlay.
+    Returns (sha256, JPEG bytes); the bytes are None if the camera is
+    unavailable.
+    """
+    print("Cache miss – downloading image from source")
+    last_frame = _get_last_frame(redis_client, camera_id)
+    validators = {
+        k: last_frame[k].decode() for k in ("etag", "last_modified") if k in last_frame
+    }
+    try:
+        response_code, original_image_bytes, validators = _download_frame(
+            camera_id, validators
+        )
+        if original_image_bytes is None:
+            found, image_bytes = _last_rendered(redis_client, last_frame)
+            if not found:
+                # Nothing to re-render from: fetch the frame in full
+                print(f"Camera {camera_id} render evicted, downloading it again.")
+                response_code, original_image_bytes, validators = _download_frame(
+                    camera_id
+                )
+    except UpstreamError:
+        _record_upstream_result(redis_client, camera_id, ok=False)
+        raise
+    _record_upstream_result(redis_client, camera_id, ok=True)
+
+    if original_image_bytes is None:
+        print(f"Camera {camera_id} frame not modified upstream, reusing last render.")
+        return last_frame["sha256"].decode(), image_bytes
+
+    # Calculate SHA256 hash of the original image
+    sha256_hash = hashlib.sha256(original_image_bytes).hexdigest()
+    hash_prefix = sha256_hash[:8]
+    print(f"Image SHA256: {sha256_hash}, using prefix: {hash_prefix}")
+
+    # The same frame as last time has already been persisted, and rendered
+    # unless the render has been evicted since
+    unchanged = last_frame.get("sha256") == sha256_hash.encode()
+    if unchanged:
+        found, image_bytes = _last_rendered(redis_client, last_frame)
+        if found:
+            print(f"Camera {camera_id} frame unchanged, reusing last render.")
+            if validators:
+                try:
+                    redis_client.hset(f"camera:{camera_id}:last", mapping=validators)
+                except Exception as r_err:
+                    print(f"Failed to update frame validators in Redis: {r_err}")
+            return sha256_hash, image_bytes
+
+    # Set status based on response code and image hash
+    status = _frame_status(response_code, sha256_hash)
+    print(f"Status for camera {camera_id}: {status}")
+
+    # A failure here propagates: nothing is cached and the camera's last
+    # frame isn't recorded, so the next request downloads and persists the
+    # frame again instead of finding it unchanged
+    if unchanged:
+        print(f"Camera {camera_id} frame unchanged, rendering it again.")
+    elif redis_client and _write_behind_enabled():
+        _enqueue_persistence(
+            redis_client, camera_id, sha256_hash, status, original_image_bytes
+        )
+    else:
+        _persist_frame(camera_id, sha256_hash, status, original_image_bytes)
+
+    if status == "unavailable":
+        print(f"Camera {camera_id} is unavailable by hash match.")
+        image_bytes = None
+    else:
+        try:
+            image_bytes = _overlay().render_overlay(original_image_bytes, hash_prefix)
+        except Exception as img_err:
+            print(f"Failed to process image and add SHA overlay: {img_err}")
+            # Fall back to using the original, unmodified image
+            image_bytes = original_image_bytes
+
+    _store_last_frame(redis_client, camera_id, sha256_hash, status, validators)
+    return sha256_hash, image_bytes
+
+
+def _get_frames(redis_client, camera_ids, skip_cache):
+    """
+    Return {camera_id: (sha256, JPEG bytes)} for several cameras.  Cache hits
+    are answered in one pipelined round trip; misses are refreshed
+    concurrently in a bounded thread pool.  The bytes are None for cameras
+    that are unavailable or failed to refresh.
+    """
+    frames = {}
+    if redis_client and not skip_cache:
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for camera_id in camera_ids:
+                _lookup_frame(pipe, f"camera:{camera_id}")
+                pipe.zincrby(POPULARITY_KEY, 1, camera_id)
+            for camera_id, cached in zip(camera_ids, pipe.execute()[::2]):
+                if cached and cached[2]:
+                    frames[camera_id] = (
+                        cached[0].decode(),
+                        base64.b64decode(cached[2]),
+                    )
+        except Exception as r_err:
+            print(f"Failed to fetch from Redis cache: {r_err}")
+    print(f"Cache hits for {len(frames)} of {len(camera_ids)} cameras")
+
+    def refresh(camera_id):
+        try:
+            return _refresh_frame(redis_client, camera_id, skip_cache)
+        except Exception as e:
+            print(f"Failed to refresh camera {camera_id}: {e}")
+            return None, None
+
+    misses = [camera_id for camera_id in camera_ids if camera_id not in frames]
+    if misses:
+        with ThreadPoolExecutor(
+            max_workers=min(BATCH_MAX_WORKERS, len(misses))
+        ) as pool:
+            frames.update(zip(misses, pool.map(refresh, misses)))
+
+    return frames
+
+
+def _compose_mosaic(camera_ids, frames):
+    """Tile the frames, in request order, into a single JPEG grid."""
+    from PIL import Image
+
+    columns = math.ceil(math.sqrt(len(camera_ids)))
+    rows = math.ceil(len(camera_ids) / columns)
+    tile_width, tile_height = MOSAIC_TILE_SIZE
+    mosaic = Image.new("RGB", (columns * tile_width, rows * tile_height))
+
+    for index, camera_id in enumerate(camera_ids):
+        image_bytes = frames[camera_id][1] or _load_fallback_image()
+        tile = Image.open(io.BytesIO(image_bytes))
+        # Let the JPEG decoder do most of the downscaling
+        tile.draft("RGB", MOSAIC_TILE_SIZE)
+        tile = tile.convert("RGB")
+        tile.thumbnail(MOSAIC_TILE_SIZE)
+        row, column = divmod(index, columns)
+        mosaic.paste(
+            tile,
+            (
+                column * tile_width + (tile_width - tile.width) // 2,
+                row * tile_height + (tile_height - tile.height) // 2,
+            ),
+        )
+
+    buffer = io.BytesIO()
+    mosaic.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def _compose_multipart(camera_ids, frames, boundary):
+    """Pack the frames, in request order, into a multipart/mixed body."""
+    parts = []
+    for camera_id in camera_ids:
+        sha256_hash, image_bytes = frames[camera_id]
+        part_headers = ["Content-Type: image/jpeg", f"X-Camera-Id: {camera_id}"]
+        if image_bytes is None:
+            part_headers.append("X-Camera-Status: unavailable")
+            image_bytes = _load_fallback_image()
+        else:
+            part_headers.append(f'ETag: "{sha256_hash}"')
+        parts.append(
+            f"--{boundary}\r\n".encode()
+            + "\r\n".join(part_headers).encode()
+            + b"\r\n\r\n"
+            + image_bytes
+            + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts)
+
+
+def _batch_response(camera_ids, layout, skip_cache, if_none_match):
+    """
+    Answer a token naming several cameras with one response: either a
+    multipart/mixed body with a part per camera or, with layout=mosaic, a
+    single JPEG grid of all of them.
+    """
+    if not camera_ids or len(camera_ids) > BATCH_MAX_CAMERAS:
+        return {
+            "statusCode": 400,
+            "headers": {"Content-Type": "application/json", **CORS_HEADERS},
+            "body": json.dumps(
+                {"error": f"Between 1 and {BATCH_MAX_CAMERAS} cameras per request"}
+            ),
+        }
+    if layout not in ("multipart", "mosaic"):
+        return {
+            "statusCode": 400,
+            "headers": {"Content-Type": "application/json", **CORS_HEADERS},
+            "body": json.dumps({"error": f"Unknown layout: {layout}"}),
+        }
+
+    frames = _get_frames(_get_redis_client(), camera_ids, skip_cache)
+
+    # The response is fully determined by the layout and the member frames
+    batch_hash = hashlib.sha256(
+        ":".join(
+            [layout] + [frames[camera_id][0] or "-" for camera_id in camera_ids]
+        ).encode()
+    ).hexdigest()
+    if _etag_matches(if_none_match, batch_hash):
+        print("Batch unchanged – client already holds it")
+        return _not_modified_response(batch_hash, 0)
+
+    if layout == "mosaic":
+        content_type = "image/jpeg"
+        body = _compose_mosaic(camera_ids, frames)
+    else:
+        boundary = f"frame-{batch_hash[:16]}"
+        content_type = f"multipart/mixed; boundary={boundary}"
+        body = _compose_multipart(camera_ids, frames, boundary)
+
+    return {
+        "statusCode": 200,
+        "headers": {
+            "Content-Type": content_type,
+            **_frame_cache_headers(batch_hash, 0),
+            **CORS_HEADERS,
+        },
+        "isBase64Encoded": True,
+        "body": base64.b64encode(body).decode("utf-8"),
+    }
+
+
+@_profile_startup
 def handler(event, context):
     """
     Main Lambda handler function
@@ -176,9 +1164,16 @@ def handler(event, context):
                     "JWT signature cannot be verified by server"
                 )
 
-            # If we're here, token was decoded. Try to get camera ID.
-            camera_id = str(decoded_token["coaCamera"])
-            print(f"Using camera ID from JWT: {camera_id}")
+            # If we're here, token was decoded. A token naming several cameras
+            # is answered with all of them at once.
+            camera_ids = decoded_token.get("coaCameras")
+            if camera_ids is not None:
+                camera_ids = [str(c) for c in camera_ids]
+                print(f"Using camera IDs from JWT: {', '.join(camera_ids)}")
+            else:
+                # Otherwise try to get the camera ID.
+                camera_id = str(decoded_token["coaCamera"])
+                print(f"Using camera ID from JWT: {camera_id}")
 
             # Check for no-cache directive in JWT
             skip_cache = decoded_token.get("no-cache", False)
@@ -192,8 +1187,32 @@ def handler(event, context):
                 )
             return _serve_fallback_image(reason)
 
+        if camera_ids is not None:
+            layout = (query_params or {}).get("layout", "multipart")
+            return _batch_response(
+                camera_ids, layout, skip_cache, headers.get("if-none-match")
+            )
+
+        # Smaller and/or WebP derivatives of the frame can be requested
+        size = (query_params or {}).get("size", "full")
+        image_format = (query_params or {}).get("format", "jpeg")
+        if size not in DERIVATIVE_SIZES or image_format not in IMAGE_FORMATS:
+            return {
+                "statusCode": 400,
+                "headers": {"Content-Type": "application/json", **CORS_HEADERS},
+                "body": json.dumps(
+                    {"error": f"Unsupported size={size} or format={image_format}"}
+                ),
+            }
+
         cache_key = f"camera:{camera_id}"
+        suffix = _variant_suffix(size, image_format)
+        if_none_match = headers.get("if-none-match")
+        sha256_hash = None
         image_bytes = None
+        encoded_image = None
+        content_type = f"image/{image_format}"
+        max_age = CACHE_TTL_SECONDS
 
         # Attempt to fetch the image from Redis first
         redis_client = _get_redis_client()
@@ -202,219 +1221,373 @@ def handler(event, context):
                 print("'no-cache' in JWT, skipping Redis lookup.")
             else:
                 try:
-                    cached = redis_client.get(cache_key)
+                    # Only the hash and TTL are needed to answer a revalidation;
+                    # otherwise the stored body is served as it is
+                    pipe = redis_client.pipeline(transaction=False)
+                    _lookup_frame(pipe, cache_key, suffix, with_body=not if_none_match)
+                    pipe.zincrby(POPULARITY_KEY, 1, camera_id)
+                    cached = pipe.execute()[0]
                     if cached:
-                        print("Cache hit – serving image from Redis")
-                        image_bytes = cached
+                        sha256_hash = cached[0].decode()
+                        max_age = max(cached[1], 0)
+                        etag = _variant_etag(sha256_hash, size, image_format)
+                        if _etag_matches(if_none_match, etag):
+                            print("Cache hit – client already holds this frame")
+                            return _not_modified_response(etag, max_age)
+                        if len(cached) > 2:
+                            encoded_body, stored_type = cached[2:]
+                        else:
+                            encoded_body, stored_type = _get_frame(
+                                redis_client, sha256_hash, suffix
+                            )
+                        if encoded_body:
+                            encoded_image = encoded_body.decode()
+                            content_type = stored_type.decode()
+                        elif suffix:
+                            # Render the derivative from the cached frame
+                            encoded_frame, _ = _get_frame(redis_client, sha256_hash)
+                            if encoded_frame:
+                                image_bytes = base64.b64decode(encoded_frame)
+                        if encoded_image is None and image_bytes is None:
+                            print("Cached frame evicted – refreshing")
+                        else:
+                            print("Cache hit – serving image from Redis")
                 except Exception as r_err:
                     print(f"Failed to fetch from Redis cache: {r_err}")
 
         # If not cached, download from the Austin Mobility CCTV feed
-        if image_bytes is None:
-            with db.tx() as transaction:
-                print("Cache miss – downloading image from source")
-                image_url = f"https://cctv.austinmobility.io/image/{camera_id}.jpg"
-                with urllib.request.urlopen(image_url) as img_response:
-                    response_code = img_response.getcode()
-                    original_image_bytes = img_response.read()
+        if encoded_image is None and image_bytes is None:
+            max_age = CACHE_TTL_SECONDS
+            sha256_hash, image_bytes = _refresh_frame(
+                redis_client, camera_id, skip_cache
+            )
 
-                try:
-                    # Calculate SHA256 hash of the original image
-                    sha256_hash = hashlib.sha256(original_image_bytes).hexdigest()
-                    hash_prefix = sha256_hash[:8]
-                    print(f"Image SHA256: {sha256_hash}, using prefix: {hash_prefix}")
-
-                    unavailable_image_hash = os.environ.get("UNAVAILABLE_IMAGE_HASH")
-
-                    # Set status based on response code and image hash
-                    status = (
-                        "unavailable"
-                        if (
-                            response_code == 200
-                            and sha256_hash == unavailable_image_hash
-                        )
-                        else str(response_code)
-                    )
+            if image_bytes is None:
+                return _serve_fallback_image(
+                    f"Camera {camera_id} is unavailable.", status_code=503
+                )
 
-                    print(f"Status for camera {camera_id}: {status}")
+            etag = _variant_etag(sha256_hash, size, image_format)
+            if _etag_matches(if_none_match, etag):
+                print("Fresh frame unchanged – client already holds it")
+                return _not_modified_response(etag, max_age)
 
-                    status_record = transaction.status.upsert(
-                        where={"name": status},
-                        data={"create": {"name": status}, "update": {}},
-                    )
-                    camera_record = transaction.camera.upsert(
-                        where={"coaId": int(camera_id)},
-                        data={
-                            "create": {
-                                "coaId": int(camera_id),
-                                "statusId": status_record.id,
-                            },
-                            "update": {"statusId": status_record.id},
-                        },
-                    )
+        if encoded_image is None and suffix:
+            body_bytes = _overlay().render_derivative(
+                image_bytes,
+                sha256_hash[:8],
+                DERIVATIVE_SIZES[size],
+                IMAGE_FORMATS[image_format],
+            )
+            if redis_client and not skip_cache:
+                encoded_image = _store_variant(
+                    redis_client, sha256_hash, suffix, content_type, body_bytes
+                )
+            else:
+                encoded_image = base64.b64encode(body_bytes).decode("utf-8")
+        elif encoded_image is None:
+            # Encode binary payload as base64 for Lambda response
+            encoded_image = base64.b64encode(image_bytes).decode("utf-8")
 
-                    camera_status_record = transaction.camerastatus.create(
-                        data={
-                            "cameraId": camera_record.id,
-                            "statusId": status_record.id,
-                        }
-                    )
+        response = {
+            "statusCode": 200,
+            "headers": {
+                "Content-Type": content_type,
+                **_frame_cache_headers(
+                    _variant_etag(sha256_hash, size, image_format),
+                    0 if skip_cache else max_age,
+                ),
+                **CORS_HEADERS,
+            },
+            "isBase64Encoded": True,
+            "body": encoded_image,
+        }
+        return response
 
-                    if status == "unavailable":
-                        print(f"Camera {camera_id} is unavailable by hash match.")
-                        return _serve_fallback_image(
-                            f"Camera {camera_id} is unavailable.", status_code=503
-                        )
-
-                    image_record = transaction.image.create(
-                        data={
-                            "hash": sha256_hash,
-                            "cameraId": camera_record.id,
-                            "statusId": status_record.id,
-                            "s3Uploaded": False,
-                            "detectionsProcessed": False,
-                        }
-                    )
+    except Exception as e:
+        print(f"Error processing event: {e}")
+        return {
+            "statusCode": 500,
+            "headers": {"Content-Type": "application/json", **CORS_HEADERS},
+            "body": json.dumps({"error": str(e)}),
+        }
 
-                    try:
-                        s3_bucket = os.environ.get(
-                            "S3_BUCKET_NAME", "atx-traffic-cameras"
-                        )
-                        s3_key = f"cameras/{camera_id}/{sha256_hash}.jpg"
-
-                        s3 = boto3.client(
-                            "s3",
-                            region_name=os.environ.get("AWS_REGION", "us-east-1"),
-                        )
-
-                        try:
-                            s3.head_object(Bucket=s3_bucket, Key=s3_key)
-                            print(
-                                f"File already exists in S3: s3://{s3_bucket}/{s3_key}, skipping upload."
-                            )
-                            # Update image record to reflect it exists in S3
-                            transaction.image.update(
-                                where={"id": image_record.id}, data={"s3Uploaded": True}
-                            )
-                        except s3.exceptions.ClientError as e:
-                            if e.response["Error"]["Code"] == "404":
-                                print(
-                                    f"Uploading image to S3: s3://{s3_bucket}/{s3_key}"
-                                )
-                                s3.upload_fileobj(
-                                    io.BytesIO(original_image_bytes),
-                                    s3_bucket,
-                                    s3_key,
-                                    ExtraArgs={"ContentType": "image/jpeg"},
-                                )
-                                print("Successfully uploaded to S3.")
-                                # Update image record after successful upload
-                                transaction.image.update(
-                                    where={"id": image_record.id},
-                                    data={"s3Uploaded": True},
-                                )
-                            else:
-                                # Log other client errors
-                                print(f"Error checking S3 for {s3_key}: {e}")
-                    except Exception as s3_err:
-                        print(f"An error occurred during S3 operation: {s3_err}")
-
-                    img = Image.open(io.BytesIO(original_image_bytes)).convert("RGBA")
-
-                    # Define a baseline for scaling UI elements. 1080p is a common standard.
-                    base_height = 1080.0
-                    scale_factor = img.height / base_height
-
-                    # Scale font size and margin based on the image's vertical resolution.
-                    # Ensure a minimum size of 1 to avoid errors with tiny images.
-                    font_size = max(1, int(32 * scale_factor))
-                    margin = max(1, int(10 * scale_factor))
-
-                    # Try to load a suitable fixed-width font
-                    font = None
-                    # Common paths for fonts in Lambda/Linux environments
-                    font_paths = [
-                        "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf",
-                        "/usr/share/fonts/truetype/liberation/LiberationMono-Regular.ttf",
-                    ]
-                    for path in font_paths:
-                        try:
-                            font = ImageFont.truetype(path, font_size)
-                            break
-                        except IOError:
-                            continue
-
-                    if not font:
-                        print(
-                            "Could not load a truetype font, falling back to default."
-                        )
-                        try:
-                            # Pillow >= 9.5.0 supports the size argument
-                            font = ImageFont.load_default(size=font_size)
-                        except AttributeError:
-                            print(
-                                "Warning: Pillow version may not support 'size' for load_default(). Using default size."
-                            )
-                            font = ImageFont.load_default()
 
-                    draw = ImageDraw.Draw(img)
+def _ensure_persist_group(redis_client):
+    """Create the persistence consumer group (and stream) if missing."""
+    try:
+        redis_client.xgroup_create(PERSIST_STREAM, PERSIST_GROUP, id="0", mkstream=True)
+    except redis.exceptions.ResponseError as err:
+        if "BUSYGROUP" not in str(err):
+            raise
 
-                    # Position text in the upper right corner
-                    text_bbox = draw.textbbox((0, 0), hash_prefix, font=font)
-                    text_width = text_bbox[2] - text_bbox[0]
 
-                    x = img.width - text_width - margin
-                    y = margin
+def _claim_persist_entries(redis_client, consumer):
+    """
+    Return the next batch of stream entries for this consumer.  Entries left
+    pending by a consumer that died mid-batch are reclaimed first.
+    """
+    claimed = redis_client.xautoclaim(
+        PERSIST_STREAM,
+        PERSIST_GROUP,
+        consumer,
+        min_idle_time=PERSIST_CLAIM_IDLE_MS,
+        start_id="0-0",
+        count=PERSIST_BATCH_SIZE,
+    )
+    entries = [entry for entry in claimed[1] if entry[1]]
+    if entries:
+        print(f"Reclaimed {len(entries)} abandoned persistence records")
+        return entries
 
-                    # Create a blurred black shadow
-                    shadow_layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
-                    shadow_draw = ImageDraw.Draw(shadow_layer)
-                    shadow_draw.text((x, y), hash_prefix, font=font, fill="black")
-                    shadow_layer = shadow_layer.filter(
-                        ImageFilter.GaussianBlur(radius=5)
-                    )
+    response = redis_client.xreadgroup(
+        PERSIST_GROUP, consumer, {PERSIST_STREAM: ">"}, count=PERSIST_BATCH_SIZE
+    )
+    return response[0][1] if response else []
 
-                    # Composite the shadow onto the image
-                    img = Image.alpha_composite(img, shadow_layer)
 
-                    # Draw the white text on top
-                    final_draw = ImageDraw.Draw(img)
-                    final_draw.text((x, y), hash_prefix, font=font, fill="white")
+def _persist_batch(redis_client, entries):
+    """
+    Write a batch of queued frames' bookkeeping rows with a handful of bulk
+    statements in a single transaction, then archive the originals to S3.
+    The rows are committed first: the upload is what triggers the detector,
+    which looks the frame up by hash.
+    """
+    records = []
+    for entry_id, fields in entries:
+        record = {k.decode(): v.decode() for k, v in fields.items()}
+        record["entry_id"] = entry_id
+        record["captured_at"] = datetime.fromisoformat(record["captured_at"])
+        records.append(record)
 
-                    # Save the modified image to a buffer
-                    buffer = io.BytesIO()
-                    img.convert("RGB").save(buffer, format="JPEG")
-                    image_bytes = buffer.getvalue()
+    image_records = [r for r in records if "original_key" in r]
+    originals = (
+        redis_client.mget([r["original_key"] for r in image_records])
+        if image_records
+        else []
+    )
 
-                except Exception as img_err:
-                    print(f"Failed to process image and add SHA overlay: {img_err}")
-                    # Fall back to using the original, unmodified image
-                    image_bytes = original_image_bytes
+    # Stream order is capture order, so the last record wins per camera
+    latest_status = {int(r["camera_id"]): r["status"] for r in records}
+    coa_ids = list(latest_status)
 
-                # Store the fresh result in Redis (TTL 60 seconds)
-                if redis_client and not skip_cache:
-                    try:
-                        redis_client.setex(cache_key, 60 * 5, image_bytes)
-                        print("Stored image in Redis with TTL=300s")
+    with _db_transaction() as transaction:
+        status_ids = {
+            name: transaction.status.upsert(
+                where={"name": name},
+                data={"create": {"name": name}, "update": {}},
+            ).id
+            for name in {r["status"] for r in records}
+        }
 
-                    except Exception as r_err:
-                        print(f"Failed to store image in Redis: {r_err}")
+        transaction.camera.create_many(
+            data=[
+                {"coaId": coa_id, "statusId": status_ids[status]}
+                for coa_id, status in latest_status.items()
+            ],
+            skip_duplicates=True,
+        )
+        for name, status_id in status_ids.items():
+            ids = [c for c, status in latest_status.items() if status == name]
+            if ids:
+                transaction.camera.update_many(
+                    where={"coaId": {"in": ids}}, data={"statusId": status_id}
+                )
+        camera_ids = {
+            camera.coaId: camera.id
+            for camera in transaction.camera.find_many(where={"coaId": {"in": coa_ids}})
+        }
 
-        # Encode binary payload as base64 for Lambda response
-        encoded_image = base64.b64encode(image_bytes).decode("utf-8")
+        transaction.camerastatus.create_many(
+            data=[
+                {
+                    "cameraId": camera_ids[int(r["camera_id"])],
+                    "statusId": status_ids[r["status"]],
+                    "createdAt": r["captured_at"],
+                }
+                for r in records
+            ]
+        )
+        if image_records:
+            # Unchanged frames re-queue an existing hash, skip those rows
+            transaction.image.create_many(
+                data=[
+                    {
+                        "hash": r["sha256"],
+                        "cameraId": camera_ids[int(r["camera_id"])],
+                        "statusId": status_ids[r["status"]],
+                        "s3Uploaded": False,
+                        "detectionsProcessed": False,
+                        "createdAt": r["captured_at"],
+                    }
+                    for r in image_records
+                ],
+                skip_duplicates=True,
+            )
 
-        response = {
-            "statusCode": 200,
-            "headers": {"Content-Type": "image/jpeg", **CORS_HEADERS},
-            "isBase64Encoded": True,
-            "body": encoded_image,
+    # Upload the originals concurrently; head_object makes retries idempotent
+    def archive(record, original_image_bytes):
+        if original_image_bytes is None:
+            print(f"Original for {record['sha256']} expired before archiving")
+            return False
+        return _archive_to_s3(
+            record["camera_id"], record["sha256"], original_image_bytes
+        )
+
+    uploaded = []
+    if image_records:
+        with ThreadPoolExecutor(max_workers=PERSIST_UPLOAD_WORKERS) as pool:
+            uploaded = list(pool.map(archive, image_records, originals))
+
+    uploaded_hashes = list(
+        {r["sha256"] for r, s3_uploaded in zip(image_records, uploaded) if s3_uploaded}
+    )
+    if uploaded_hashes:
+        with _db_transaction() as transaction:
+            transaction.image.update_many(
+                where={"hash": {"in": uploaded_hashes}}, data={"s3Uploaded": True}
+            )
+
+    entry_ids = [r["entry_id"] for r in records]
+    pipe = redis_client.pipeline()
+    pipe.xack(PERSIST_STREAM, PERSIST_GROUP, *entry_ids)
+    pipe.xdel(PERSIST_STREAM, *entry_ids)
+    if image_records:
+        pipe.delete(*{r["original_key"] for r in image_records})
+    pipe.execute()
+    print(
+        f"Persisted {len(records)} records ({len(image_records)} images, "
+        f"{sum(uploaded)} in S3) for {len(coa_ids)} cameras"
+    )
+
+
+@_profile_startup
+def persist_handler(event, context):
+    """
+    Lambda handler for the write-behind persistence consumer
+    Drains the records queued by handler() when WRITE_BEHIND is enabled and
+    writes them to Postgres and S3 in bulk.  Run it on a schedule.
+    Parameters:
+        event: Dict containing the Lambda function event data (unused)
+        context: Lambda runtime context
+    Returns:
+        Dict with the number of records persisted
+    """
+    redis_client = _get_redis_client()
+    if not redis_client:
+        return {
+            "statusCode": 503,
+            "body": json.dumps({"error": "Redis unavailable"}),
         }
-        return response
 
+    _ensure_persist_group(redis_client)
+    consumer = socket.gethostname()
+
+    persisted = 0
+    for _ in range(PERSIST_MAX_BATCHES):
+        entries = _claim_persist_entries(redis_client, consumer)
+        if not entries:
+            break
+        try:
+            _persist_batch(redis_client, entries)
+        except Exception as e:
+            # Leave the entries pending, they are reclaimed on a later run
+            print(f"Failed to persist batch of {len(entries)} records: {e}")
+            return {
+                "statusCode": 500,
+                "body": json.dumps({"error": str(e), "persisted": persisted}),
+            }
+        persisted += len(entries)
+
+    return {"statusCode": 200, "body": json.dumps({"persisted": persisted})}
+
+
+def _warm_camera(redis_client, camera_id):
+    """
+    Refresh a camera ahead of its cache expiry.  Skips cameras whose refresh
+    is already in flight.  Returns True if the camera was refreshed.
+    """
+    cache_key = f"camera:{camera_id}"
+    if _circuit_open(redis_client, camera_id):
+        print(f"Circuit open for camera {camera_id}, not warming.")
+        return False
+    lock = redis_client.lock(
+        f"lock:{cache_key}", timeout=SINGLE_FLIGHT_LOCK_TTL_SECONDS, blocking=False
+    )
+    try:
+        acquired = lock.acquire()
+    except Exception as r_err:
+        print(f"Failed to acquire single-flight lock, not warming: {r_err}")
+        return False
+    if not acquired:
+        print(f"Refresh of camera {camera_id} already in flight, not warming.")
+        return False
+    try:
+        _refresh_and_cache(redis_client, camera_id, cache_key)
+        return True
     except Exception as e:
-        print(f"Error processing event: {e}")
+        print(f"Failed to warm camera {camera_id}: {e}")
+        return False
+    finally:
+        try:
+            lock.release()
+        except Exception as r_err:
+            print(f"Failed to release single-flight lock: {r_err}")
+
+
+@_profile_startup
+def warm_handler(event, context):
+    """
+    Lambda handler for the scheduled cache warmer
+    Refreshes the most requested cameras shortly before their cached frame
+    expires, so their viewers keep hitting the cache.  Run it every minute.
+    Parameters:
+        event: Dict containing the Lambda function event data (unused)
+        context: Lambda runtime context
+    Returns:
+        Dict with the cameras that were warmed
+    """
+    redis_client = _get_redis_client()
+    if not redis_client:
         return {
-            "statusCode": 500,
-            "headers": {"Content-Type": "application/json", **CORS_HEADERS},
-            "body": json.dumps({"error": str(e)}),
+            "statusCode": 503,
+            "body": json.dumps({"error": "Redis unavailable"}),
         }
+
+    # Age the request counts so popularity tracks recent viewing
+    pipe = redis_client.pipeline()
+    pipe.zunionstore(POPULARITY_KEY, {POPULARITY_KEY: POPULARITY_DECAY})
+    pipe.zremrangebyscore(POPULARITY_KEY, 0, 0.5)
+    pipe.zrevrange(POPULARITY_KEY, 0, WARM_TOP_K - 1)
+    hot_cameras = [camera_id.decode() for camera_id in pipe.execute()[-1]]
+
+    pipe = redis_client.pipeline(transaction=False)
+    for camera_id in hot_cameras:
+        pipe.ttl(f"camera:{camera_id}")
+    # A TTL of -2 means the frame has already expired
+    expiring = [
+        camera_id
+        for camera_id, ttl in zip(hot_cameras, pipe.execute())
+        if ttl < WARM_AHEAD_SECONDS
+    ]
+    print(f"{len(expiring)} of {len(hot_cameras)} hot cameras are due for warming")
+
+    warmed = []
+    if expiring:
+        with ThreadPoolExecutor(
+            max_workers=min(BATCH_MAX_WORKERS, len(expiring))
+        ) as pool:
+            results = pool.map(
+                lambda camera_id: _warm_camera(redis_client, camera_id), expiring
+            )
+            warmed = [camera_id for camera_id, ok in zip(expiring, results) if ok]
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"hot": len(hot_cameras), "warmed": warmed}),
+    }
+
+
+startup_timings["module_import_ms"] = round(
+    (time.perf_counter() - _import_started) * 1000, 2
+)
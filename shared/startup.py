@@ -0,0 +1,74 @@
+"""
+Lazy initialisation shared by the proxy and detector Lambdas: the Prisma
+client, connected on first use, and the timings behind their STARTUP_PROFILE
+logs.  Each Dockerfile copies this file next to its handler.
+"""
+
+import contextlib
+import threading
+import time
+
+# Milliseconds spent on module import and on each lazy initialisation
+startup_timings = {}
+
+# The Prisma client, connected on first use; see get_db().  Handlers use it
+# from thread pools, so it is created under a lock.
+_db = None
+_db_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def timed_init(name):
+    """
+    Record how long a lazy initialisation takes, for STARTUP_PROFILE.  Only
+    the first, real, initialisation of each name counts.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings.setdefault(
+            f"{name}_ms", round((time.perf_counter() - start) * 1000, 2)
+        )
+
+
+def get_db():
+    """
+    Return the shared Prisma client, connecting on first use (and again
+    after reset_db()) instead of at import time.
+    """
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                with timed_init("prisma"):
+                    from prisma import Prisma
+
+                    client = Prisma()
+                    client.connect()
+                _db = client
+    return _db
+
+
+def reset_db(error):
+    """
+    Drop the Prisma client after a failure, unless it was about the data
+    itself, so the next use reconnects rather than reusing a connection that
+    may have died along with its query engine.
+    """
+    global _db
+    if _db is None:
+        return
+    from prisma.errors import DataError
+
+    if isinstance(error, DataError):
+        return
+    with _db_lock:
+        client, _db = _db, None
+    if client is None:
+        return
+    print(f"Dropping the database connection after: {error}")
+    try:
+        client.disconnect()
+    except Exception as e:
+        print(f"Error disconnecting from the database: {e}")